@@ -0,0 +1,353 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import Client
+import LoadTest
+from HashUtils import compute_file_hash, build_manifest
+from Progress import TransferProgress
+
+
+BENCHMARKS = ["serve", "transfer", "swarm", "hash", "tracker", "memory"]
+TRACKER_STARTUP_TIMEOUT = 10  # Seconds to wait for the benchmark tracker to answer
+TRACKER_ACTIONS = ["REGISTER", "REQUEST", "HEARTBEAT"]  # Tracker actions reported by the tracker benchmark
+
+
+def legacySend(conn, f, offset, count):
+    '''The original serving loop: one read and one send per BUFFER_SIZE chunk.'''
+    f.seek(offset)
+    remaining = count
+    while remaining and (chunk := f.read(min(Client.BUFFER_SIZE, remaining))):
+        conn.sendall(chunk)
+        remaining -= len(chunk)
+
+
+def makeTestFile(directory, size):
+    '''Writes `size` random bytes to a file in `directory` and returns its path.'''
+    path = os.path.join(directory, f"bench_{size}.bin")
+    with open(path, 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        remaining = size
+        while remaining:
+            f.write(block[:min(len(block), remaining)])
+            remaining -= min(len(block), remaining)
+    return path
+
+
+def benchServe(send_body, path):
+    '''Serves `path` over a loopback TCP connection with `send_body` and measures it.
+    Returns throughput in MB/s and the serving thread's CPU seconds per GB sent.'''
+    size = os.path.getsize(path)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    result = {}
+
+    def serve():
+        conn, _ = server.accept()
+        try:
+            cpu_start = time.thread_time()
+            with open(path, 'rb') as f:
+                send_body(conn, f, 0, size)
+            result["cpu"] = time.thread_time() - cpu_start
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    client = socket.create_connection(server.getsockname())
+    buffer = bytearray(1024 * 1024)
+    received = 0
+    start = time.perf_counter()
+    while received < size:
+        read = client.recv_into(buffer)
+        if not read:
+            break
+        received += read
+    elapsed = time.perf_counter() - start
+    client.close()
+    thread.join()
+    server.close()
+
+    gigabytes = size / (1024 ** 3)
+    return {
+        "mb_per_s": round(size / elapsed / (1024 * 1024), 2),
+        "cpu_s_per_gb": round(result.get("cpu", 0.0) / gigabytes, 3)
+    }
+
+
+def benchServing(sizes_mb, repeat):
+    '''Compares the original 1 KiB read/send loop with the sendfile serving path.'''
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size_mb in sizes_mb:
+            path = makeTestFile(directory, size_mb * 1024 * 1024)
+            for name, send_body in (("legacy_loop", legacySend), ("sendfile", Client.sendFileBody)):
+                runs = [benchServe(send_body, path) for _ in range(repeat)]
+                best = max(runs, key=lambda run: run["mb_per_s"])
+                results.append({"benchmark": "serve", "method": name, "size_mb": size_mb, **best})
+    return results
+
+
+@contextlib.contextmanager
+def quiet():
+    '''Silences the peers' console messages while a benchmark runs.'''
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def freePort(kind=socket.SOCK_DGRAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def currentRss():
+    '''Resident memory of this process in bytes (peak resident memory where /proc is not available).'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+@contextlib.contextmanager
+def benchTracker():
+    '''Runs a tracker in a subprocess on a free port, without a state file, and yields its (host, port).'''
+    port = freePort()
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "Tracker.py"),
+                                "--port", str(port), "--log-level", "WARNING", "--state", ""])
+    tracker = ('127.0.0.1', port)
+    try:
+        deadline = time.time() + TRACKER_STARTUP_TIMEOUT
+        with quiet():
+            while Client.Peer(*tracker).trackerStats() is None:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("Benchmark tracker did not start")
+        yield tracker
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def startPeers(tracker, count):
+    peers = [Client.Peer(*tracker) for _ in range(count)]
+    for peer in peers:
+        peer.start()
+    return peers
+
+
+def benchDownload(tracker, seeders, path, directory):
+    '''Seeds `path` from `seeders` fresh peers and downloads it with another one. Returns the download's result dict.'''
+    filename = os.path.basename(path)
+    peers = startPeers(tracker, seeders + 1)
+    try:
+        for peer in peers[1:]:
+            peer.seedFiles({filename: path})
+        output = os.path.join(directory, "downloaded_" + filename)
+        result = peers[0].downloadFile(filename, output, TransferProgress(filename))
+        Client.removeQuietly(output)
+        return result
+    finally:
+        for peer in peers:
+            peer.stop()
+
+
+def benchTransfer(tracker, sizes_mb, repeat):
+    '''End-to-end download from a single seeder over loopback, through the tracker, for each file size.'''
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size_mb in sizes_mb:
+            runs = []
+            for _ in range(repeat):
+                # New bytes for every run, so no earlier seeder or download can join the swarm
+                path = makeTestFile(directory, size_mb * 1024 * 1024)
+                runs.append(benchDownload(tracker, 1, path, directory))
+                os.remove(path)
+            if not all(run["ok"] for run in runs):
+                results.append({"benchmark": "transfer", "size_mb": size_mb, "error": next(run["error"] for run in runs if not run["ok"])})
+                continue
+            best = min(runs, key=lambda run: run["seconds"])
+            results.append({"benchmark": "transfer", "size_mb": size_mb, "seconds": round(best["seconds"], 3),
+                            "mb_per_s": round(best["rate"] / (1024 * 1024), 2)})
+    return results
+
+
+def benchSwarm(tracker, size_mb, seeder_counts, repeat):
+    '''Time to download one file from 1, 2, 4... seeders at once.'''
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for seeders in seeder_counts:
+            runs = []
+            for _ in range(repeat):
+                path = makeTestFile(directory, size_mb * 1024 * 1024)
+                runs.append(benchDownload(tracker, seeders, path, directory))
+                os.remove(path)
+            entry = {"benchmark": "swarm", "size_mb": size_mb, "seeders": seeders}
+            if not all(run["ok"] for run in runs):
+                entry["error"] = next(run["error"] for run in runs if not run["ok"])
+            else:
+                best = min(runs, key=lambda run: run["seconds"])
+                entry.update(seconds=round(best["seconds"], 3), mb_per_s=round(best["rate"] / (1024 * 1024), 2),
+                             seeders_used=best["seeders"])
+            results.append(entry)
+    return results
+
+
+def benchHashing(size_mb, repeat):
+    '''Whole-file hashing and piece manifest building in MB/s, from the page cache and without the hash cache.'''
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = makeTestFile(directory, size_mb * 1024 * 1024)
+        for name, hash_file in (("file_hash", lambda: compute_file_hash(path, use_cache=False)),
+                                ("manifest", lambda: build_manifest(path, use_cache=False))):
+            hash_file()  # Warm the page cache
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                hash_file()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results.append({"benchmark": "hash", "method": name, "size_mb": size_mb,
+                            "mb_per_s": round(size_mb / best, 2)})
+    return results
+
+
+def benchTrackerLoad(tracker, num_peers, num_files, duration):
+    '''Drives the tracker with LoadTest's simulated peers and reads back how many of each action it handled and how fast.'''
+    with quiet():
+        before = Client.Peer(*tracker).trackerStats() or {}
+    load = asyncio.run(LoadTest.runLoad(tracker[0], tracker[1], num_peers, num_files, files_per_peer=3,
+                                        duration=duration, concurrency=32, request_ratio=0.5))
+    time.sleep(0.5)  # Let the tracker drain its queue before reading its counters
+    with quiet():
+        after = Client.Peer(*tracker).trackerStats() or {}
+
+    results = [{"benchmark": "tracker", "method": "load_test", **load}]
+    for action in TRACKER_ACTIONS:
+        name = f"tracker.requests.{action}"
+        latency = after.get("histograms", {}).get(f"tracker.latency.{action}") or {}
+        mean = latency.get("mean")
+        results.append({
+            "benchmark": "tracker", "method": action, "peers": num_peers,
+            "handled": after.get("counters", {}).get(name, 0) - before.get("counters", {}).get(name, 0),
+            # Handler time only: how many of these one tracker process could serve per second
+            "capacity_per_s": round(1 / mean, 1) if mean else None,
+            "p50_ms": round(latency["p50"] * 1000, 3) if latency.get("p50") is not None else None,
+            "p99_ms": round(latency["p99"] * 1000, 3) if latency.get("p99") is not None else None
+        })
+    results.append({"benchmark": "tracker", "method": "dropped", "peers": num_peers,
+                    "count": after.get("counters", {}).get("tracker.dropped", 0) - before.get("counters", {}).get("tracker.dropped", 0)})
+    return results
+
+
+def benchMemory(tracker, count):
+    '''Resident memory added by each running peer that seeds one small file.
+    Runs in a fresh process so earlier benchmarks do not skew the numbers.'''
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--only", "memory-child",
+                              "--tracker", f"{tracker[0]}:{tracker[1]}", "--peers", str(count), "--json"],
+                             capture_output=True, text=True)
+    if process.returncode:
+        return [{"benchmark": "memory", "peers": count, "error": process.stderr.strip().splitlines()[-1:]}]
+    return json.loads(process.stdout)["results"]
+
+
+def measureMemory(tracker, count):
+    with tempfile.TemporaryDirectory() as directory:
+        path = makeTestFile(directory, 1024 * 1024)
+        baseline = currentRss()
+        threads = threading.active_count()
+        peers = startPeers(tracker, count)
+        for index, peer in enumerate(peers):
+            peer.seedFiles({f"memory_{index}.bin": path})
+        time.sleep(0.5)
+        used = currentRss() - baseline
+        added_threads = threading.active_count() - threads
+        for peer in peers:
+            peer.stop()
+    return [{"benchmark": "memory", "peers": count, "rss_mb": round(used / (1024 * 1024), 2),
+             "kb_per_peer": round(used / count / 1024, 1), "threads_per_peer": round(added_threads / count, 1)}]
+
+
+def environment():
+    '''What the results were measured on, so runs can be compared release to release.'''
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "revision": revision, "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def runBenchmarks(args):
+    '''Runs the selected benchmarks against a tracker of our own, or the one given with --tracker.'''
+    if args.tracker:
+        host, port = args.tracker.rsplit(":", 1)
+        tracker_context = contextlib.nullcontext((host, int(port)))
+    else:
+        tracker_context = benchTracker() if set(args.only) - {"serve", "hash"} else contextlib.nullcontext()
+    results = []
+    with tracker_context as tracker, quiet():
+        if "serve" in args.only:
+            results += benchServing(args.sizes, args.repeat)
+        if "transfer" in args.only:
+            results += benchTransfer(tracker, args.sizes, args.repeat)
+        if "swarm" in args.only:
+            results += benchSwarm(tracker, args.swarm_size, args.seeders, args.repeat)
+        if "hash" in args.only:
+            results += benchHashing(max(args.sizes), args.repeat)
+        if "tracker" in args.only:
+            results += benchTrackerLoad(tracker, args.tracker_peers, args.tracker_files, args.duration)
+        if "memory" in args.only:
+            results += benchMemory(tracker, args.peers)
+        if "memory-child" in args.only:
+            results += measureMemory(tracker, args.peers)
+    return results
+
+
+def describeResult(entry):
+    details = "  ".join(f"{key}={value}" for key, value in entry.items() if key != "benchmark")
+    return f"{entry['benchmark']:>9}  {details}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loopback benchmarks for the transfer path, hashing and the tracker.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS + ["memory-child"], default=BENCHMARKS, metavar="NAME",
+                        help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 16, 64, 256], help="File sizes to serve and download, in MiB")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement; the best is reported")
+    parser.add_argument("--swarm-size", type=int, default=64, help="File size for the multi-seeder download, in MiB")
+    parser.add_argument("--seeders", type=int, nargs="+", default=[1, 2, 4, 8], help="Seeder counts for the multi-seeder download")
+    parser.add_argument("--tracker-peers", type=int, default=10000, help="Simulated peers for the tracker benchmark")
+    parser.add_argument("--tracker-files", type=int, default=1000, help="Distinct files for the tracker benchmark")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds of tracker load")
+    parser.add_argument("--peers", type=int, default=50, help="Peers started for the memory benchmark")
+    parser.add_argument("--tracker", metavar="HOST:PORT", help="Use a running tracker instead of starting one")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--output", metavar="PATH", help="Also write the JSON results to PATH")
+    args = parser.parse_args()
+
+    report = {"environment": environment(), "results": runBenchmarks(args)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for entry in report["results"]:
+            print(describeResult(entry))
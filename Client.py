@@ -1,251 +1,924 @@
-import tkinter as tk
-from tkinter import ttk
+import argparse
+import collections
+import contextlib
 import socket
+import sys
 import threading
 import json
 import os
 import time
-from HashUtils import compute_file_hash, verify_file_integrity
+from concurrent.futures import ThreadPoolExecutor
+from HashUtils import compute_file_hash, verify_file_integrity, build_manifest, build_manifests, verify_manifest, verify_piece, PieceVerifier, StreamVerifier, get_hash_cache
+from Downloader import SwarmDownload, fetch_ranges, fetch_files, available_pieces, range_available, partial_path, preallocate, remove_partial
+from Uploader import UploadScheduler
+from SharedDirectory import SharedDirectory, RESCAN_INTERVAL
+from RateLimit import upload_limits, download_limits
+from Progress import TransferProgress, ConsoleProgress, gui_available, run_with_window, format_bytes
+from PeerProtocol import is_framed, recv_next_message, send_message, unpack_peers, pack_bitfield
+from Metrics import metrics, enable_profiling, format_metrics
 
 
 TRACKER_IP = '127.0.0.1'
 TRACKER_PORT = 5000
-PEER_PORT = 6000 
+PEER_PORT = 0  # Port peers listen on; 0 picks a free one
 BUFFER_SIZE = 1024
+SEND_BUFFER_SIZE = 1024 * 1024  # Reused buffer for platforms without sendfile
+KEEPALIVE_TIMEOUT = 30  # Seconds an idle peer connection is kept open for further requests
+LISTEN_BACKLOG = 128  # Connections the OS queues while the accept loop catches up
+UPLOAD_WORKERS = 8  # Uploads served at once
+UPLOAD_SLOTS_PER_PEER = 2  # Uploads one downloader can hold at once, so a single peer cannot take every worker
+MAX_UPLOAD_CONNECTIONS = 256  # Open connections from downloaders; further ones are refused
+RATE_LIMIT_CHUNK = 64 * 1024  # Slice size when pacing a rate-limited upload
+UNLIMITED_SLICE = 4 * 1024 * 1024  # Slice size of an unlimited upload, so a limit set meanwhile applies from the next slice
+RECEIVE_BUFFER_SIZE = 256 * 1024  # Reused buffer a whole-file download is received into
+DOWNLOAD_WORKERS = 8  # Files downloaded at the same time by a batch download
+SMALL_FILE_SIZE = 1024 * 1024  # Batch downloads fetch files up to this size whole, many per request
+SMALL_FILE_BATCH = 64  # Small files asked of one seeder in one pipelined batch
+SHOW_PROGRESS = True  # Draw a console progress bar while downloading
+PROGRESS_WINDOW = True  # Show progress in a tkinter window instead when a display is available
+TRACKER_BUFFER_SIZE = 65507  # Tracker replies carry manifests, so use the largest UDP payload
 HEARTBEAT_INTERVAL = 10 
-running = True  
-boolSeeder = False  # Boolean variable that keeps record of whether the state change from leecher to seeder has occured.
-heartbeat_started = False  # Flag to ensure heartbeat thread is started only once
+HEARTBEAT_TIMEOUT = 2.0  # Seconds to wait for a heartbeat ack
+HEARTBEAT_RETRY_INTERVAL = 2.0  # Seconds between heartbeats while the tracker is not answering
+PEER_REQUEST_LIMIT = 50  # Seeders asked for per REQUEST; the tracker returns a random sample of large swarms
+ANNOUNCE_BATCH_BYTES = 60000  # Files packed into one ANNOUNCE datagram, by encoded size
+ANNOUNCE_TIMEOUT = 1.0  # Seconds to wait for the first ANNOUNCE ack; doubles on each retry
+ANNOUNCE_RETRIES = 4
+SCRAPE_BATCH_BYTES = 60000  # Filenames packed into one SCRAPE request, by the encoded size of their reply
+VERIFY_ON_DISK = False  # Re-read finished downloads to verify them; streaming verification already covers every byte
 
-def registerSeeder(filename):
-    '''Function that registers the seeder to the tracker with file hash.'''
-    global heartbeat_started
-    try:
-        # Compute file hash
-        file_hash = compute_file_hash(filename)
-        if file_hash is None:
-            print('\033[31m'+f"Error: Cannot compute hash for {filename}. File may not exist."+'\033[0m')
-            return
-        
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(5)  # 5 second timeout
-        message = json.dumps({
-            "action": "REGISTER", 
-            "filename": filename, 
-            "port": PEER_PORT,
-            "file_hash": file_hash
-        }).encode()
-        sock.sendto(message, (TRACKER_IP, TRACKER_PORT))
-        sock.close()
-        print('\033[32m'+f"Registered {filename} with tracker on port {PEER_PORT}."+'\033[0m')
-        print('\033[32m'+f"File Hash (SHA256): {file_hash[:16]}..."+'\033[0m')
-        # Start heartbeat thread only once
-        if not heartbeat_started:
-            heartbeat_started = True
-            threading.Thread(target=heartbeatMessage, daemon=True).start()
-    except socket.timeout:
-        print('\033[31m'+"Error: Failed to register with tracker (timeout). Tracker may be unreachable."+'\033[0m')
-    except Exception as e:
-        print('\033[31m'+f"Error registering with tracker: {e}"+'\033[0m')
-
-def heartbeatMessage():
-    '''Function responsible for send hearbeat messages to the tracker, to indicate the 'alive' state.'''
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(5)  # 5 second timeout for each send
+def announceBatches(entries, removed=()):
+    '''Packs (filename, manifest) entries and removed filenames into ANNOUNCE messages that each fit in one datagram.
+    Yields (files, removed) pairs.'''
+    files, gone, batch_size = [], [], 0
+    items = [("files", {"filename": filename, "file_hash": manifest["hash"], "manifest": manifest}) for filename, manifest in entries]
+    items += [("removed", filename) for filename in removed]
+    for kind, item in items:
+        item_size = len(json.dumps(item)) + 2
+        if (files or gone) and batch_size + item_size > ANNOUNCE_BATCH_BYTES:
+            yield files, gone
+            files, gone, batch_size = [], [], 0
+        (files if kind == "files" else gone).append(item)
+        batch_size += item_size
+    if files or gone:
+        yield files, gone
+
+def scrapeBatches(filenames):
+    '''Splits filenames into SCRAPE requests whose replies, the name plus its seeder count, each fit in one datagram.'''
+    batch, batch_size = [], 0
+    for filename in filenames:
+        item_size = len(json.dumps(filename)) + 12
+        if batch and batch_size + item_size > SCRAPE_BATCH_BYTES:
+            yield batch
+            batch, batch_size = [], 0
+        batch.append(filename)
+        batch_size += item_size
+    if batch:
+        yield batch
+
+def sendFileBody(conn, f, offset, count, limiter=None):
+    '''Sends `count` bytes of an open file starting at `offset`.
+    Uses zero-copy sendfile where the OS has it, otherwise a large reused buffer with sendall.
+    With a rate limiter the body goes out in slices, and the limit is looked up again for each one:
+    while it is set every slice is paid for before it is sent, otherwise slices are large.'''
+    if count <= 0:
+        return 0  # socket.sendfile treats a count of 0 as "the whole file"
+    if limiter is not None:
+        sent = 0
+        while sent < count:
+            limited = limiter.limited
+            size = min(RATE_LIMIT_CHUNK if limited else UNLIMITED_SLICE, count - sent)
+            if limited:
+                limiter.consume(size)
+            part = sendFileBody(conn, f, offset + sent, size)
+            if not part:
+                break  # The file got shorter
+            sent += part
+        return sent
+    if hasattr(os, 'sendfile'):
+        return conn.sendfile(f, offset, count)
+    
+    buffer = bytearray(min(SEND_BUFFER_SIZE, max(count, 1)))
+    view = memoryview(buffer)
+    f.seek(offset)
+    sent = 0
+    while sent < count:
+        read = f.readinto(view[:min(len(buffer), count - sent)])
+        if not read:
+            break
+        conn.sendall(view[:read])
+        sent += read
+    return sent
+
+def uploadLimiter(conn):
+    '''Returns the rate limiter for uploads on a connection. It follows later changes to the limits, including setting or removing them.'''
+    return upload_limits.connection(conn)
+
+def setRateLimits(upload=None, download=None, per_connection_upload=None, per_connection_download=None):
+    '''Sets upload and download limits in bytes per second, for all transfers together and per connection.
+    None removes a limit. Takes effect immediately, including on transfers already running.'''
+    upload_limits.set(upload, per_connection_upload)
+    download_limits.set(download, per_connection_download)
+
+def pickSwarm(peers):
+    '''Groups seeders by content hash and returns (manifest, { (ip, port): filename }) for the largest group with a valid manifest.'''
+    swarms = {}
+    for peer_info in peers:
+        if not isinstance(peer_info, dict):
+            continue
+        manifest = peer_info.get("manifest")
+        if manifest and manifest.get("hash") == peer_info.get("hash"):
+            swarm = swarms.setdefault(peer_info["hash"], (manifest, {}))[1]
+            swarm[(peer_info["ip"], peer_info["port"])] = peer_info.get("filename")
+    for manifest, swarm in sorted(swarms.values(), key=lambda entry: len(entry[1]), reverse=True):
+        if verify_manifest(manifest):
+            return manifest, swarm
+    return None, {}
+
+def removeQuietly(path):
+    '''Deletes a file if it exists.'''
     try:
-        while running: # As long as the peer is running, the messages have to be sent.
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class Peer:
+    '''
+    One peer in the network: serves files to other peers and downloads from them.
+
+    Everything a peer needs (its port, tracker address, the files it shares
+    and its announce sequence) lives on the instance, so a process can run
+    several peers and one peer can run many downloads at once. Methods return
+    plain data (bools, counts, dicts and lists) so the peer can be driven
+    from other code as well as from the menus and command line below.
+    '''
+
+    def __init__(self, tracker_ip=TRACKER_IP, tracker_port=TRACKER_PORT, port=PEER_PORT):
+        self.tracker = (tracker_ip, tracker_port)
+        self.port = port
+        self.running = False
+        self.seeding = False  # Whether this peer has changed state from leecher to seeder
+        self.shared = {}  # { advertised filename: local path } for every file this peer serves
+        self.seeds = set()  # Filenames registered with the tracker
+        self.directories = []  # SharedDirectory for each directory tree being shared
+        self.heartbeat_started = False  # Flag to ensure heartbeat thread is started only once
+        self.announce_seq = 0  # Sequence number matching ANNOUNCE and HEARTBEAT messages to their acks
+        self.announced = {}  # { filename: manifest } for everything announced, re-sent if the tracker loses it
+        self.tracker_id = None  # Identifies the tracker process that acknowledged our announcements
+        self.lock = threading.Lock()
+        self.server = None
+        self.uploads = None
+
+    # Peer server
+
+    def start(self):
+        '''Start the peer server: accepted connections are handed to a fixed pool of upload workers. Returns the port.'''
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('0.0.0.0', self.port))
+        self.port = self.server.getsockname()[1]
+        self.server.listen(LISTEN_BACKLOG)
+        self.uploads = UploadScheduler(self.serveRequest, workers=UPLOAD_WORKERS, slots_per_peer=UPLOAD_SLOTS_PER_PEER,
+                                       max_connections=MAX_UPLOAD_CONNECTIONS, idle_timeout=KEEPALIVE_TIMEOUT)
+        self.uploads.start()
+        self.running = True
+        threading.Thread(target=self.acceptConnections, daemon=True).start()
+        print('\033[33m'+f"Peer listening on port {self.port}"+'\033[0m')
+        return self.port
+
+    def acceptConnections(self):
+        try:
+            while self.running:
+                conn, addr = self.server.accept()
+                # The header and body go out as separate writes; without this Nagle holds the body back
+                # until the previous reply is acknowledged, adding a delayed-ACK stall to every request
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                metrics.incr("peer.connections")
+                self.uploads.add(conn, addr)
+        except OSError:
+            pass  # Server socket closed by stop()
+        finally:
+            self.uploads.stop()
+
+    def stats(self):
+        '''Returns this process's metrics plus the upload scheduler's connection and request counts.'''
+        snapshot = metrics.snapshot()
+        if self.uploads:
+            with self.uploads.condition:
+                snapshot["gauges"].update({
+                    "upload.connections": len(self.uploads.connections),
+                    "upload.queued": self.uploads.queued,
+                    "upload.active": sum(self.uploads.active.values())
+                })
+                snapshot["counters"].update({f"upload.{name}": count for name, count in self.uploads.stats.items()})
+        snapshot["gauges"]["peer.shared_files"] = len(self.shared)
+        return snapshot
+
+    def stop(self):
+        '''Tell the tracker this peer is leaving and stop serving.'''
+        if self.seeds or self.heartbeat_started:
+            self.exit()
+        self.running = False
+        if self.server:
             try:
-                message = json.dumps({"action": "HEARTBEAT", "port": PEER_PORT}).encode()
-                sock.sendto(message, (TRACKER_IP, TRACKER_PORT))
-            except socket.timeout:
-                print('\033[31m'+"Heartbeat timeout - tracker may be unreachable"+'\033[0m')
-            except Exception as e:
-                print('\033[31m'+f"Error sending heartbeat: {e}"+'\033[0m')
-            time.sleep(HEARTBEAT_INTERVAL)
-    finally:
-        sock.close()
-        print('\033[31m'+"Heartbeat thread closed."+'\033[0m')
+                self.server.shutdown(socket.SHUT_RDWR)  # Wakes the accept loop
+            except OSError:
+                pass
+            self.server.close()
+            print('\033[31m'+"Peer server closed."+'\033[0m')
 
-def exit():
-    '''Function to quit the program thus disconnecting the peer.'''
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(5)  # 5 second timeout
-        message = json.dumps({"action": "EXIT", "port": PEER_PORT}).encode()
-        sock.sendto(message, (TRACKER_IP, TRACKER_PORT))
-        sock.close()
-    except socket.timeout:
-        print('\033[31m'+"Warning: Failed to notify tracker of exit (timeout)."+'\033[0m')
-    except Exception as e:
-        print('\033[31m'+f"Warning: Error notifying tracker of exit: {e}"+'\033[0m')
-
-
-def downloadInterface():
-    '''Simple GUI interface that simulates a loading bar for downloading a file'''
-    loading_root = tk.Tk()
-    loading_root.title("Downloading...")
-    loading_root.geometry("300x120")
-
-    label = tk.Label(loading_root, text="Downloading...")
-    label.pack(pady=10)
-
-    progress_bar = ttk.Progressbar(loading_root, mode='determinate', length=250)
-    progress_bar.pack(pady=10, fill=tk.X, padx=20)
-    progress_bar["maximum"] = 100
-
-    def update_progress(value=0):
-        if value <= 100:
-            progress_bar["value"] = value
-            loading_root.after(30, update_progress, value + 1)  
-        else:
-            loading_root.destroy()  
+    def resolvePath(self, filename):
+        '''Local path of a file other peers ask for by name, or None if this peer does not share it.
+        Only shared files (and the partial copies of downloads in progress) are ever served.'''
+        return self.shared.get(filename) if isinstance(filename, str) else None
 
-    loading_root.after(10, update_progress)  
-    loading_root.mainloop()
+    def sendRange(self, conn, addr, request):
+        '''Serves a byte range of a file: a framed JSON header followed by exactly the requested bytes.
+        The header echoes the request's "id" and, if asked for with "hash", carries the whole file's hash.
+        A "have" request gets the bitfield of pieces this peer can serve instead of file data,
+        and a "stats" request gets this peer's metrics.'''
+        reply = {"id": request["id"]} if "id" in request else {}
+        if request.get("action") == "stats":
+            metrics.incr("peer.requests.stats")
+            send_message(conn, dict(reply, status="success", metrics=self.stats(), length=0))
+            return
+        filename = request.get("filename")
+        path = self.resolvePath(filename)
+        # A file we are still downloading is served piece by piece, once each piece is verified and on disk
+        available = available_pieces(path) if path else None
+        if available is not None and os.path.isfile(partial_path(path)):
+            path = partial_path(path)  # The pieces so far are in the download's temporary file
+        if not path or not os.path.isfile(path):
+            send_message(conn, dict(reply, status="error", message="File not found"))
+            return
+        
+        size = os.path.getsize(path)
+        try:
+            offset = int(request.get("offset", 0))
+            length = int(request.get("length", size - offset))
+        except (TypeError, ValueError):
+            offset, length = -1, -1
+        if offset < 0 or length < 0 or offset + length > size:
+            send_message(conn, dict(reply, status="error", message="Invalid range"))
+            return
+        
+        metrics.incr("peer.requests.have" if request.get("action") == "have" else "peer.requests.range")
+        if request.get("action") == "have":
+            if available is None:
+                send_message(conn, dict(reply, status="success", complete=True, length=0))
+            else:
+                piece_size, done = available
+                num_pieces = -(-size // piece_size) if piece_size > 0 else 0
+                send_message(conn, dict(reply, status="success", complete=False, piece_size=piece_size,
+                                        pieces=pack_bitfield(done, num_pieces), length=0))
+            return
+        if not range_available(available, offset, length):
+            send_message(conn, dict(reply, status="missing", message="Piece not downloaded yet"))
+            return
+        
+        if request.get("hash"):
+            reply["hash"] = compute_file_hash(path)  # Served from the hash cache for unchanged files
+        send_message(conn, dict(reply, status="success", size=size, offset=offset, length=length))
+        with open(path, 'rb') as f:
+            sendFileBody(conn, f, offset, length, uploadLimiter(conn))
+        metrics.incr("peer.bytes_sent", length)
 
-def requestHosts(filename):
-    '''Function that makes a request to Tracker for seeders hosting a particular file with their hashes.'''
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(5)  # 5 second timeout
-        message = json.dumps({"action": "REQUEST", "filename": filename}).encode()
-        sock.sendto(message, (TRACKER_IP, TRACKER_PORT))
-        data, _ = sock.recvfrom(BUFFER_SIZE)
-        sock.close()
-        return json.loads(data.decode())
-    except socket.timeout:
-        print('\033[31m'+"Error: Tracker request timed out. Tracker may be unreachable."+'\033[0m')
-        return []
-    except Exception as e:
-        print('\033[31m'+f"Error requesting hosts from tracker: {e}"+'\033[0m')
-        return []
-
-def handleConnection(conn, addr):
-    '''Handles request for a certain file and sends hash + file chunks to the requested peer'''
-    try:
+    @metrics.timed("peer.serve")
+    def serveRequest(self, conn, addr):
+        '''Serves the next request on a connection; returns True if the connection should stay open for another.'''
+        first = conn.recv(1, socket.MSG_PEEK)
+        if not first:
+            return False  # Peer closed the connection
+        if is_framed(first):
+            # Keep-alive connection: framed ranged requests, answered in order
+            request = recv_next_message(conn)
+            if request is None:
+                return False
+            self.sendRange(conn, addr, request)
+            return True
+        
+        # Plain filename: stream the whole file
         filename = conn.recv(BUFFER_SIZE).decode()
-        if os.path.exists(filename):
+        path = self.resolvePath(filename)
+        if path and available_pieces(path) is not None:
+            conn.send(json.dumps({"hash": "", "status": "error", "message": "File is still downloading"}).encode())
+        elif path and os.path.isfile(path):
             # Compute and send file hash first
-            file_hash = compute_file_hash(filename)
+            file_hash = compute_file_hash(path)
             conn.send(json.dumps({"hash": file_hash, "status": "success"}).encode())
             
-            # Send file in chunks
-            with open(filename, 'rb') as f:
-                while chunk := f.read(BUFFER_SIZE):
-                    conn.send(chunk)
+            # Send the whole file
+            with open(path, 'rb') as f:
+                sent = sendFileBody(conn, f, 0, os.fstat(f.fileno()).st_size, uploadLimiter(conn))
+            metrics.incr("peer.requests.whole_file")
+            metrics.incr("peer.bytes_sent", sent)
             print(f"Sent {filename} to {addr}")
         else:
             conn.send(json.dumps({"hash": "", "status": "error", "message": "File not found"}).encode())
-    finally:
-        conn.close()
-
-def startPeer():
-    '''Start the peer thread so it can handle connections.'''
-    global PEER_PORT
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(('0.0.0.0', 0))  
-    PEER_PORT = server.getsockname()[1]
-    server.listen(5)
-    print('\033[33m'+f"Peer listening on port {PEER_PORT}"+'\033[0m')
-    
-    try:
-        while running:
-            conn, addr = server.accept()
-            threading.Thread(target=handleConnection, args=(conn, addr)).start()
-    finally:
-        server.close()
-        print('\033[31m'+"Peer server closed."+'\033[0m')
-
-def downloadFile(filename):
-    '''Function to download a particular file with integrity verification.'''
-    global boolSeeder
-    peers = requestHosts(filename)
-    if not peers:
-        print('\033[31m'+"No seeders hosting this file."+'\033[0m')
         return False
-    
-    downloadInterface() # Simulate download
-    for peer_info in peers:
+
+    # Tracker communication
+
+    def startHeartbeat(self):
+        '''Start the heartbeat thread, only once.'''
+        with self.lock:
+            if self.heartbeat_started:
+                return
+            self.heartbeat_started = True
+        threading.Thread(target=self.heartbeatMessage, daemon=True).start()
+
+    def nextSeq(self):
+        with self.lock:
+            self.announce_seq += 1
+            return self.announce_seq
+
+    def awaitAck(self, sock, seq):
+        '''Waits for the tracker's ACK of message `seq`, skipping late acks for earlier messages. Raises socket.timeout.'''
+        while True:
+            data, _ = sock.recvfrom(TRACKER_BUFFER_SIZE)
+            reply = json.loads(data.decode())
+            if reply.get("action") == "ACK" and reply.get("seq") == seq:
+                return reply
+
+    def heartbeatMessage(self):
+        '''Function responsible for send hearbeat messages to the tracker, to indicate the 'alive' state.
+        Each heartbeat is acknowledged. If the ack shows the tracker restarted or has forgotten this peer,
+        everything is announced again. While heartbeats go unacknowledged they are retried more often.'''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(HEARTBEAT_TIMEOUT)
+        missed = 0
         try:
-            # Handle both old format (tuple) and new format (dict)
-            if isinstance(peer_info, dict):
-                peer_ip = peer_info.get("ip")
-                peer_port = peer_info.get("port")
-                expected_hash = peer_info.get("hash")
-            else:
-                # Fallback for old format
-                peer_ip, peer_port = peer_info
-                expected_hash = None
-            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((peer_ip, peer_port))
-            sock.send(filename.encode())
-            
-            # Receive hash information first
-            hash_data = json.loads(sock.recv(BUFFER_SIZE).decode())
+            while self.running: # As long as the peer is running, the messages have to be sent.
+                try:
+                    seq = self.nextSeq()
+                    message = json.dumps({"action": "HEARTBEAT", "port": self.port, "seq": seq}).encode()
+                    sock.sendto(message, self.tracker)
+                    reply = self.awaitAck(sock, seq)
+                    if not reply.get("known", True) or reply.get("tracker") != self.tracker_id:
+                        print('\033[33m'+"Tracker restarted or lost our registrations. Announcing again..."+'\033[0m')
+                        self.reannounce()
+                    missed = 0
+                except socket.timeout:
+                    missed += 1
+                    if missed == 1:
+                        print('\033[31m'+"Heartbeat timeout - tracker may be unreachable"+'\033[0m')
+                except Exception as e:
+                    print('\033[31m'+f"Error sending heartbeat: {e}"+'\033[0m')
+                time.sleep(HEARTBEAT_RETRY_INTERVAL if missed else HEARTBEAT_INTERVAL)
+        finally:
+            sock.close()
+            print('\033[31m'+"Heartbeat thread closed."+'\033[0m')
+
+    def sendAnnounce(self, entries, removed=(), replace=False):
+        '''Registers many (filename, manifest) entries with the tracker, and unregisters the `removed` filenames,
+        in as few datagrams as possible. Each datagram is retried with backoff until the tracker acknowledges it.
+        With `replace`, the entries are this peer's complete list and the tracker forgets any other files it has for it.
+        Returns the number of files acknowledged.'''
+        entries = list(entries)
+        with self.lock:
+            self.announced.update(entries)
+            for filename in removed:
+                self.announced.pop(filename, None)
+        acknowledged = 0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            batches = list(announceBatches(entries, removed))
+            if replace and not batches:
+                batches = [([], [])]  # Still tell the tracker to drop what it lists for us
+            for number, (files, gone) in enumerate(batches):
+                batch = files + gone
+                seq = self.nextSeq()
+                message = {"action": "ANNOUNCE", "port": self.port, "seq": seq, "files": files}
+                if gone:
+                    message["removed"] = gone
+                if replace and number == 0:
+                    message["replace"] = True
+                message = json.dumps(message).encode()
+                timeout = ANNOUNCE_TIMEOUT
+                for attempt in range(ANNOUNCE_RETRIES):
+                    sock.sendto(message, self.tracker)
+                    sock.settimeout(timeout)
+                    try:
+                        self.tracker_id = self.awaitAck(sock, seq).get("tracker")
+                        acknowledged += len(batch)
+                        break
+                    except socket.timeout:
+                        timeout *= 2
+                else:
+                    print('\033[31m'+f"Error: Tracker did not acknowledge {len(batch)} file(s) after {ANNOUNCE_RETRIES} attempts."+'\033[0m')
+        finally:
+            sock.close()
+        with self.lock:
+            announcing = bool(self.announced)
+        if announcing:
+            # Even unacknowledged: the heartbeat re-announces everything once the tracker answers
+            self.startHeartbeat()
+        return acknowledged
+
+    def reannounce(self):
+        '''Announces every file this peer still has to the tracker again. Returns the number acknowledged.'''
+        with self.lock:
+            entries = list(self.announced.items())
+        # Skip files that have gone away, e.g. a download that was abandoned
+        paths = {filename: self.resolvePath(filename) for filename, _ in entries}
+        entries = [(filename, manifest) for filename, manifest in entries
+                   if paths[filename] and (os.path.exists(paths[filename]) or os.path.exists(partial_path(paths[filename])))]
+        return self.sendAnnounce(entries, replace=True)
+
+    def registerSeeder(self, filename, path=None):
+        '''Function that registers the seeder to the tracker with file hash.
+        `path` is where the file is on disk if it is not shared under its own path. Returns True once registered.'''
+        path = path or filename
+        try:
+            # Build the piece manifest; it also carries the whole-file hash
+            manifest = build_manifest(path)
+            if manifest is None:
+                print('\033[31m'+f"Error: Cannot compute hash for {filename}. File may not exist."+'\033[0m')
+                return False
+            file_hash = manifest["hash"]
             
-            if hash_data.get("status") == "error":
-                print('\033[31m'+f"\nError from {peer_ip}:{peer_port}: {hash_data.get('message')}"+'\033[0m')
-                sock.close()
+            self.shared[filename] = path
+            if not self.sendAnnounce([(filename, manifest)]):
+                print('\033[31m'+"Error: Failed to register with tracker (timeout). Tracker may be unreachable."+'\033[0m')
+                return False
+            self.seeds.add(filename)
+            print('\033[32m'+f"Registered {filename} with tracker on port {self.port}."+'\033[0m')
+            print('\033[32m'+f"File Hash (SHA256): {file_hash[:16]}..."+'\033[0m')
+            print('\033[32m'+f"Pieces: {len(manifest['pieces'])} x {manifest['piece_size'] // 1024} KiB"+'\033[0m')
+            return True
+        except Exception as e:
+            print('\033[31m'+f"Error registering with tracker: {e}"+'\033[0m')
+            return False
+
+    def seedFiles(self, files):
+        '''Hashes many files in parallel and registers them all with the tracker in bulk.
+        `files` is a list of paths, or { advertised filename: path }. Returns the number of files acknowledged.'''
+        if not isinstance(files, dict):
+            files = {filename: filename for filename in files}
+        manifests = build_manifests(list(files.values()))
+        entries = []
+        for filename, path in files.items():
+            if path not in manifests:
+                print('\033[31m'+f"Error: Cannot compute hash for {filename}. File may not exist."+'\033[0m')
                 continue
-            
-            received_hash = hash_data.get("hash")
-            new_filename = "[download]"+f"{filename}"
-            
-            # Download file
-            with open(new_filename, 'wb') as f:
-                while chunk := sock.recv(BUFFER_SIZE):
-                    f.write(chunk)
+            self.shared[filename] = path
+            entries.append((filename, manifests[path]))
+        acknowledged = self.sendAnnounce(entries)
+        if acknowledged:
+            self.seeds.update(filename for filename, _ in entries)
+        print('\033[32m'+f"Registered {acknowledged}/{len(files)} file(s) with tracker on port {self.port}."+'\033[0m')
+        return acknowledged
+
+    def seedDirectory(self, directory, rescan_interval=RESCAN_INTERVAL):
+        '''Shares every file under a directory, advertised by its path relative to the directory.
+        Hashing happens in the background, and the tree is rescanned every `rescan_interval` seconds
+        (never if None) to announce new, changed and removed files. Returns the SharedDirectory.'''
+        shared = SharedDirectory(directory)
+        self.directories.append(shared)
+        threading.Thread(target=self.watchDirectory, args=(shared, rescan_interval), daemon=True).start()
+        return shared
+
+    def watchDirectory(self, shared, rescan_interval):
+        '''Keeps the tracker in step with a shared directory for as long as the peer runs.'''
+        # Files indexed by an earlier run are announced straight away; the scan then corrects any that changed
+        known = shared.entries()
+        if known:
+            self.directoryChanged({name: (path, manifest) for name, path, manifest in known}, [])
+            print('\033[32m'+f"Announced {len(known)} indexed file(s) from {shared.directory}."+'\033[0m')
+        while self.running:
+            try:
+                hashed, removed = shared.scan(self.directoryChanged)
+                if hashed or removed:
+                    print('\033[32m'+f"{shared.directory}: {hashed} new or changed, {removed} removed ({len(shared)} shared)."+'\033[0m')
+            except Exception as e:
+                print('\033[31m'+f"Error scanning {shared.directory}: {e}"+'\033[0m')
+            if not rescan_interval:
+                return
+            time.sleep(rescan_interval)
+
+    def directoryChanged(self, changed, removed):
+        '''Shares and announces new or changed files ({ name: (path, manifest) }) and withdraws removed ones.'''
+        for name in removed:
+            self.shared.pop(name, None)
+        for name, (path, _) in changed.items():
+            self.shared[name] = path
+        self.sendAnnounce([(name, manifest) for name, (_, manifest) in changed.items()], removed)
+
+    def scrapeFiles(self, filenames):
+        '''Asks the tracker how many seeders each file has. Returns { filename: seeder_count }.'''
+        counts = {}
+        filenames = list(filenames)
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)  # 5 second timeout
+            pending = list(scrapeBatches(filenames))
+            while pending:
+                batch = pending.pop()
+                sock.sendto(json.dumps({"action": "SCRAPE", "filenames": batch}).encode(), self.tracker)
+                data, _ = sock.recvfrom(TRACKER_BUFFER_SIZE)
+                answered = json.loads(data.decode()).get("files", {})
+                counts.update(answered)
+                # The tracker answers what fits in one datagram; ask again for the rest
+                unanswered = [filename for filename in batch if filename not in answered]
+                if answered and unanswered:
+                    pending.append(unanswered)
             sock.close()
-            
-            print('\033[32m'+f"\nDownloaded {filename} from {peer_ip}:{peer_port}"+'\033[0m')
-            
-            # Verify file integrity
-            if received_hash and verify_file_integrity(new_filename, received_hash):
-                print('\033[32m'+"Download complete. Becoming a seeder..."+'\033[0m')
-                registerSeeder(new_filename)
-                boolSeeder = True  
-                return True
-            elif not received_hash:
-                print('\033[33m'+"Warning: No hash provided by seeder. Proceeding without integrity check."+'\033[0m')
-                print('\033[32m'+"Download complete. Becoming a seeder..."+'\033[0m')
-                registerSeeder(new_filename)
-                boolSeeder = True
-                return True
-            else:
-                # Hash verification failed
-                print('\033[31m'+"Integrity check failed. File may be corrupted. Trying next seeder..."+'\033[0m')
+        except socket.timeout:
+            print('\033[31m'+"Error: Tracker scrape timed out. Tracker may be unreachable."+'\033[0m')
+        except Exception as e:
+            print('\033[31m'+f"Error scraping tracker: {e}"+'\033[0m')
+        return counts
+
+    def trackerStats(self):
+        '''Fetches the tracker's metrics: request counts and latencies, traffic and registry sizes. None if it does not answer.'''
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)  # 5 second timeout
+            sock.sendto(json.dumps({"action": "METRICS"}).encode(), self.tracker)
+            data, _ = sock.recvfrom(TRACKER_BUFFER_SIZE)
+            sock.close()
+            return json.loads(data.decode())
+        except Exception as e:
+            print('\033[31m'+f"Error requesting tracker metrics: {e}"+'\033[0m')
+            return None
+
+    def peerStats(self, peer):
+        '''Fetches another peer's metrics over its peer port; `peer` is (ip, port). None if it does not answer.'''
+        try:
+            [(header, _)] = fetch_ranges(peer, [{"action": "stats"}])
+            return header.get("metrics")
+        except Exception as e:
+            print('\033[31m'+f"Error requesting metrics from {peer[0]}:{peer[1]}: {e}"+'\033[0m')
+            return None
+
+    def exit(self):
+        '''Function to quit the program thus disconnecting the peer.'''
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(5)  # 5 second timeout
+            message = json.dumps({"action": "EXIT", "port": self.port}).encode()
+            sock.sendto(message, self.tracker)
+            sock.close()
+        except socket.timeout:
+            print('\033[31m'+"Warning: Failed to notify tracker of exit (timeout)."+'\033[0m')
+        except Exception as e:
+            print('\033[31m'+f"Warning: Error notifying tracker of exit: {e}"+'\033[0m')
+
+    def queryTracker(self, message):
+        '''Sends a query to the tracker and returns its decoded reply, resending with backoff like ANNOUNCE
+        since a large reply is lost if any of its fragments is. Raises socket.timeout if no reply comes.'''
+        message = json.dumps(message).encode()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            timeout = ANNOUNCE_TIMEOUT
+            for attempt in range(ANNOUNCE_RETRIES):
+                sock.sendto(message, self.tracker)
+                sock.settimeout(timeout)
                 try:
-                    os.remove(new_filename)
-                except:
-                    pass
-                continue
-                
+                    data, _ = sock.recvfrom(TRACKER_BUFFER_SIZE)
+                    return json.loads(data.decode())
+                except socket.timeout:
+                    timeout *= 2
+            raise socket.timeout(f"no reply after {ANNOUNCE_RETRIES} attempts")
+        finally:
+            sock.close()
+
+    def requestManifest(self, file_hash):
+        '''Fetches the manifest for a content hash from the tracker, for replies too large to include it.'''
+        try:
+            return self.queryTracker({"action": "MANIFEST", "file_hash": file_hash}).get("manifest")
         except Exception as e:
-            print('\033[31m'+f"\nFailed to download from {peer_ip}:{peer_port} - {e}"+ '\033[0m')
-    
-    print('\033[31m'+"Download failed."+'\033[0m')
-    return False
-
-def seederList(filename):
-    '''Returns a list of seeders hosting a particular file with hashes.'''
-    peers = requestHosts(filename)
-    if peers:
-        print(f"\nSeeders hosting '{filename}':")
-        for peer_info in peers:
-            if isinstance(peer_info, dict):
-                ip = peer_info.get("ip")
-                port = peer_info.get("port")
-                file_hash = peer_info.get("hash")
-                print('\033[32m'+f"- {ip}:{port}"+'\033[0m')
-                if file_hash:
-                    print(f"  Hash (SHA256): {file_hash[:16]}...")
+            print('\033[31m'+f"Error requesting manifest from tracker: {e}"+'\033[0m')
+            return None
+
+    def queryPeers(self, message, filename=None):
+        '''Sends a REQUEST-style message to the tracker and returns the seeders in its reply as dicts
+        with ip, port, hash, the filename to ask that seeder for, and the manifest for the hash.'''
+        try:
+            response = self.queryTracker(message)
+            if isinstance(response, list):
+                # Fallback for trackers that only return the peer list
+                return response
+            manifests = response.get("manifests", {})
+            if "swarms" in response:
+                # Compact reply: packed seeders grouped under their content hash and filename
+                peers = [{"ip": ip, "port": port, "hash": swarm["hash"], "filename": swarm.get("filename") or filename}
+                         for swarm in response["swarms"] for ip, port in unpack_peers(swarm["peers"])]
             else:
-                # Fallback for old format
-                print('\033[32m'+f"- {peer_info[0]}:{peer_info[1]}"+'\033[0m')
-    else:
-        print('\033[31m'+f"\nNo seeders found for '{filename}'."+'\033[0m')
+                peers = response.get("peers", [])
+            if response.get("manifests_omitted"):
+                for file_hash in {peer_info.get("hash") for peer_info in peers} - set(manifests):
+                    manifests[file_hash] = self.requestManifest(file_hash)
+            # Attach each seeder's manifest to its entry
+            for peer_info in peers:
+                peer_info["manifest"] = manifests.get(peer_info.get("hash"))
+            return peers
+        except socket.timeout:
+            print('\033[31m'+"Error: Tracker request timed out. Tracker may be unreachable."+'\033[0m')
+            return []
+        except Exception as e:
+            print('\033[31m'+f"Error requesting hosts from tracker: {e}"+'\033[0m')
+            return []
+
+    def requestHosts(self, filename, limit=PEER_REQUEST_LIMIT):
+        '''Function that makes a request to Tracker for seeders hosting a particular file with their hashes and manifests.'''
+        return self.queryPeers({"action": "REQUEST", "filename": filename, "limit": limit, "compact": True}, filename)
+
+    def requestHostsByHash(self, file_hash, limit=PEER_REQUEST_LIMIT):
+        '''Requests every seeder of a piece of content from the tracker, whatever name each one shares it under.'''
+        return self.queryPeers({"action": "REQUEST_BY_HASH", "file_hash": file_hash, "limit": limit, "compact": True})
+
+    def seederList(self, filename):
+        '''Prints and returns the seeders hosting a particular file with hashes.'''
+        peers = self.requestHosts(filename)
+        if peers:
+            print(f"\nSeeders hosting '{filename}':")
+            for peer_info in peers:
+                if isinstance(peer_info, dict):
+                    ip = peer_info.get("ip")
+                    port = peer_info.get("port")
+                    file_hash = peer_info.get("hash")
+                    print('\033[32m'+f"- {ip}:{port}"+'\033[0m')
+                    if file_hash:
+                        print(f"  Hash (SHA256): {file_hash[:16]}...")
+                else:
+                    # Fallback for old format
+                    print('\033[32m'+f"- {peer_info[0]}:{peer_info[1]}"+'\033[0m')
+        else:
+            print('\033[31m'+f"\nNo seeders found for '{filename}'."+'\033[0m')
+        return peers
+
+    # Downloading
+
+    @metrics.timed("download.file")
+    def downloadFile(self, filename, output=None, progress=None):
+        '''Function to download a particular file with integrity verification, then seed it.
+        The file is saved to `output`, by default "[download]" + filename in the working directory.
+        Bytes received are reported to `progress` (a TransferProgress); by default a console progress bar.
+        Returns a result dict: filename, output, ok, error, bytes, seconds, rate and seeders.'''
+        started = time.time()
+        new_filename = output or "[download]"+f"{filename}"
+        # A download saved under its own name is shared under the name others asked for
+        seed_name = filename if output else new_filename
+        result = {"filename": filename, "output": new_filename, "ok": False, "error": None,
+                  "bytes": 0, "seconds": 0.0, "rate": 0.0, "seeders": 0}
+        metrics.add_gauge("download.active", 1)
+
+        def finish(ok, error=None):
+            result["ok"], result["error"] = ok, error
+            result["seconds"] = time.time() - started
+            metrics.add_gauge("download.active", -1)
+            metrics.incr("download.ok" if ok else "download.failed")
+            if ok:
+                result["bytes"] = os.path.getsize(new_filename)
+                result["rate"] = result["bytes"] / max(result["seconds"], 1e-6)
+                metrics.incr("download.bytes", result["bytes"])
+                print('\033[32m'+"Download complete. Becoming a seeder..."+'\033[0m')
+                self.registerSeeder(seed_name, new_filename)
+                self.seeding = True
+            else:
+                print('\033[31m'+f"Download failed: {error}"+'\033[0m')
+            return result
+
+        def ours(peer_info):
+            # Our own partial copy from an earlier attempt
+            return peer_info.get("port") == self.port and peer_info.get("filename") == seed_name
+
+        peers = [peer_info for peer_info in self.requestHosts(filename)
+                 if not (isinstance(peer_info, dict) and ours(peer_info))]
+        if not peers:
+            return finish(False, "No seeders hosting this file.")
+        
+        if progress is None:
+            progress = TransferProgress(filename, listeners=[ConsoleProgress()] if SHOW_PROGRESS else [])
+        if os.path.dirname(new_filename):
+            os.makedirs(os.path.dirname(new_filename), exist_ok=True)
+        
+        # Download pieces from every seeder of the best-supported manifest at once
+        manifest, swarm = pickSwarm(peers)
+        if manifest:
+            # Pool in seeders sharing the same bytes under other names, e.g. [download] copies
+            for peer_info in self.requestHostsByHash(manifest["hash"]):
+                if peer_info.get("port") == self.port and peer_info.get("filename") == seed_name:
+                    continue
+                swarm.setdefault((peer_info["ip"], peer_info["port"]), peer_info.get("filename"))
+            peer_filenames = {peer: name or filename for peer, name in swarm.items()}
+            result["seeders"] = len(swarm)
+            print('\033[33m'+f"Downloading {filename} from {len(swarm)} seeder(s) in parallel..."+'\033[0m')
+            download = SwarmDownload(filename, manifest, list(peer_filenames), new_filename, peer_filenames, progress)
+            # Announce the partial copy right away so other downloaders can fetch the pieces we already have
+            self.shared[seed_name] = new_filename
+            self.sendAnnounce([(seed_name, dict(manifest, filename=os.path.basename(new_filename)))])
+            completed = download.run()
+            if completed:
+                # Every piece was checked against the manifest as it arrived
+                print('\033[32m'+f"✓ All {download.num_pieces} pieces verified against root hash {manifest['root_hash'][:16]}..."+'\033[0m')
+            if completed and (not VERIFY_ON_DISK or verify_file_integrity(new_filename, manifest["hash"])):
+                # The verified manifest describes the new file, so seeding it needs no rehash
+                get_hash_cache().put(new_filename, dict(manifest, filename=os.path.basename(new_filename)))
+                return finish(True)
+            if not completed and download.done:
+                # Keep the partial file and its progress sidecar for the next attempt
+                return finish(False, f"Download interrupted at {len(download.done)}/{download.num_pieces} pieces. Download again to resume.")
+            print('\033[33m'+"Parallel download failed. Falling back to single-seeder download..."+'\033[0m')
+            remove_partial(new_filename)
+            # The partial copy is gone, so stop sending other downloaders to it
+            self.shared.pop(seed_name, None)
+            self.sendAnnounce([], removed=[seed_name])
+        
+        for peer_info in peers:
+            try:
+                # Handle both old format (tuple) and new format (dict)
+                if isinstance(peer_info, dict):
+                    peer_ip = peer_info.get("ip")
+                    peer_port = peer_info.get("port")
+                    expected_hash = peer_info.get("hash")
+                    manifest = peer_info.get("manifest")
+                    remote_name = peer_info.get("filename") or filename
+                else:
+                    # Fallback for old format
+                    peer_ip, peer_port = peer_info
+                    expected_hash = None
+                    manifest = None
+                    remote_name = filename
+                
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect((peer_ip, peer_port))
+                sock.send(remote_name.encode())
+                
+                # Receive hash information first; anything after the JSON header is already file data
+                received = sock.recv(BUFFER_SIZE).decode('latin-1')
+                hash_data, header_end = json.JSONDecoder().raw_decode(received)
+                initial_data = received[header_end:].encode('latin-1')
+                
+                if hash_data.get("status") == "error":
+                    print('\033[31m'+f"\nError from {peer_ip}:{peer_port}: {hash_data.get('message')}"+'\033[0m')
+                    sock.close()
+                    continue
+                
+                received_hash = hash_data.get("hash")
+                if expected_hash and received_hash != expected_hash:
+                    # The seeder is sending other bytes than the ones it registered
+                    print('\033[31m'+f"\nSeeder {peer_ip}:{peer_port} sends a different file than it registered. Trying next seeder..."+'\033[0m')
+                    sock.close()
+                    continue
+
+                # Only trust a manifest that is self-consistent and describes the file this seeder sends
+                if manifest and not (verify_manifest(manifest) and manifest.get("hash") == received_hash):
+                    print('\033[33m'+"Warning: Seeder manifest is inconsistent. Ignoring it."+'\033[0m')
+                    manifest = None
+                verifier = PieceVerifier(manifest) if manifest else None
+                stream_verifier = StreamVerifier(received_hash) if received_hash else None
+                
+                # Download file, hashing it as it is written and verifying each piece as soon as it is complete
+                limiter = download_limits.connection(sock)
+                progress.start(manifest["size"] if manifest else 0)
+                result["seeders"] = 1
+                # Received into one reused buffer and written to a preallocated temporary file,
+                # which only replaces the output once it has verified
+                temp_filename = partial_path(new_filename)
+                view = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+                with open(temp_filename, 'wb') as f:
+                    if manifest:
+                        preallocate(f, manifest["size"])
+                    written = 0
+                    chunk = memoryview(initial_data)
+                    while chunk or (chunk := view[:sock.recv_into(view)]):
+                        limiter.consume(len(chunk))
+                        f.write(chunk)
+                        written += len(chunk)
+                        progress.update(len(chunk), (peer_ip, peer_port))
+                        if stream_verifier:
+                            stream_verifier.update(chunk)
+                        if verifier and not verifier.update(chunk):
+                            break
+                        chunk = None
+                    f.truncate(written)  # Drop preallocated space the seeder never filled
+                sock.close()
+                progress.finish()
+                
+                if verifier and not verifier.finish():
+                    if verifier.failed_piece is not None:
+                        print('\033[31m'+f"\nPiece {verifier.failed_piece} from {peer_ip}:{peer_port} failed verification. Trying next seeder..."+'\033[0m')
+                    else:
+                        print('\033[31m'+f"\nTransfer from {peer_ip}:{peer_port} ended early. Trying next seeder..."+'\033[0m')
+                    removeQuietly(temp_filename)
+                    continue
+                
+                print('\033[32m'+f"\nDownloaded {filename} from {peer_ip}:{peer_port}"+'\033[0m')
+                
+                # Verify file integrity from the streamed hash, re-reading the file only if asked to
+                if received_hash and stream_verifier.verify(new_filename) and (not VERIFY_ON_DISK or verify_file_integrity(temp_filename, received_hash)):
+                    os.replace(temp_filename, new_filename)
+                    if verifier:
+                        # Every piece matched the manifest, so seeding the new file needs no rehash
+                        get_hash_cache().put(new_filename, dict(manifest, filename=os.path.basename(new_filename)))
+                    return finish(True)
+                elif not received_hash:
+                    print('\033[33m'+"Warning: No hash provided by seeder. Proceeding without integrity check."+'\033[0m')
+                    os.replace(temp_filename, new_filename)
+                    return finish(True)
+                else:
+                    # Hash verification failed
+                    print('\033[31m'+"Integrity check failed. File may be corrupted. Trying next seeder..."+'\033[0m')
+                    removeQuietly(temp_filename)
+                    continue
+                    
+            except Exception as e:
+                print('\033[31m'+f"\nFailed to download from {peer_ip}:{peer_port} - {e}"+ '\033[0m')
+                removeQuietly(partial_path(new_filename))
+        
+        return finish(False, "No seeder could supply a verified copy.")
+
+    def downloadWithProgress(self, filename, output=None):
+        '''Downloads a file with live progress: in a window when there is a display to open one on, on the console otherwise.'''
+        if PROGRESS_WINDOW and gui_available():
+            progress = TransferProgress(filename)
+            return run_with_window(progress, self.downloadFile, filename, output, progress)
+        return self.downloadFile(filename, output)
+
+    def downloadSmallFiles(self, lookups, output_dir, pool):
+        '''Fetches small files whole, many per pipelined request to one seeder, and announces them in bulk.
+        `lookups` is { filename: seeders from requestHosts }. Returns { filename: result dict } for the files
+        fetched and verified; the rest are left for downloadFile.'''
+        small = {}  # { filename: (manifest, { (ip, port): name that seeder shares it under }) }
+        for filename, peers in lookups.items():
+            manifest, swarm = pickSwarm([peer_info for peer_info in peers
+                                         if not (isinstance(peer_info, dict) and peer_info.get("port") == self.port)])
+            if manifest and manifest["size"] <= SMALL_FILE_SIZE:
+                small[filename] = (manifest, swarm)
+        if not small:
+            return {}
+        # Ask the seeders holding the most of these files, so the files share connections and batches
+        holders = collections.Counter(peer for _, swarm in small.values() for peer in swarm)
+        by_seeder = {}
+        for filename, (_, swarm) in small.items():
+            by_seeder.setdefault(max(swarm, key=holders.__getitem__), []).append(filename)
+        jobs = [(peer, names[start:start + SMALL_FILE_BATCH])
+                for peer, names in by_seeder.items() for start in range(0, len(names), SMALL_FILE_BATCH)]
+
+        def fetch(job):
+            peer, batch = job
+            started = time.time()
+            try:
+                replies = fetch_files(peer, [small[filename][1][peer] or filename for filename in batch])
+            except Exception as e:
+                print('\033[33m'+f"Batch of {len(batch)} file(s) from {peer[0]}:{peer[1]} failed ({e}). Downloading them one by one."+'\033[0m')
+                return []
+            seconds = time.time() - started
+            fetched = []
+            for filename, data in zip(batch, replies):
+                manifest, swarm = small[filename]
+                if data is None or len(data) != manifest["size"] or not verify_piece(data, manifest["hash"], manifest.get("algorithm", "sha256")):
+                    continue  # downloadFile tries the other seeders
+                output = os.path.join(output_dir, filename) if output_dir else "[download]"+f"{filename}"
+                if os.path.dirname(output):
+                    os.makedirs(os.path.dirname(output), exist_ok=True)
+                with open(partial_path(output), 'wb') as f:
+                    f.write(data)
+                os.replace(partial_path(output), output)
+                local_manifest = dict(manifest, filename=os.path.basename(output))
+                get_hash_cache().put(output, local_manifest)
+                fetched.append((filename, output, local_manifest, {
+                    "filename": filename, "output": output, "ok": True, "error": None, "bytes": len(data),
+                    "seconds": seconds, "rate": len(data) / max(seconds, 1e-6), "seeders": len(swarm)}))
+            return fetched
+
+        results, entries = {}, []
+        for filename, output, manifest, result in (item for fetched in pool.map(fetch, jobs) for item in fetched):
+            # Saved under its own name in output_dir, shared under the name others ask for
+            seed_name = filename if output_dir else output
+            self.shared[seed_name] = output
+            entries.append((seed_name, manifest))
+            results[filename] = result
+            metrics.incr("download.ok")
+            metrics.incr("download.bytes", result["bytes"])
+        if entries:
+            print('\033[32m'+f"Fetched {len(entries)} small file(s) in {len(jobs)} batch(es). Becoming a seeder..."+'\033[0m')
+            if self.sendAnnounce(entries):
+                self.seeds.update(name for name, _ in entries)
+            self.seeding = True
+        return results
+
+    def downloadFiles(self, filenames, output_dir=None, workers=DOWNLOAD_WORKERS):
+        '''Downloads many files at once, `workers` at a time, without per-file progress bars.
+        Files are saved under `output_dir` with their own names if given. Small files are fetched in batches
+        from a shared seeder first; the rest go through downloadFile. Returns one result dict per file, in order.'''
+        def download(filename):
+            output = os.path.join(output_dir, filename) if output_dir else None
+            try:
+                return self.downloadFile(filename, output, TransferProgress(filename))
+            except Exception as e:
+                return {"filename": filename, "output": output, "ok": False, "error": str(e),
+                        "bytes": 0, "seconds": 0.0, "rate": 0.0, "seeders": 0}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            lookups = dict(zip(filenames, pool.map(self.requestHosts, filenames)))
+            results = self.downloadSmallFiles(lookups, output_dir, pool)
+            rest = [filename for filename in lookups if filename not in results]
+            results.update(zip(rest, pool.map(download, rest)))
+        return [results[filename] for filename in filenames]
+
 
 def verifyDownloadedFile():
     '''Manually verify the integrity of a downloaded file.'''
@@ -265,53 +938,79 @@ def verifyDownloadedFile():
         print('\033[31m'+"✗ File integrity verification failed!"+'\033[0m')
         print('\033[33m'+"The file may have been corrupted or modified."+'\033[0m')
 
-def seederMenu():
+def rateLimitMenu():
+    '''Prompts for upload and download limits in KB/s; a blank answer or 0 means unlimited.'''
+    limits = []
+    for prompt in ("Total upload", "Upload per connection", "Total download", "Download per connection"):
+        answer = input(f"{prompt} limit in KB/s (blank for unlimited): ").strip()
+        try:
+            limits.append(float(answer) * 1024 if answer else None)
+        except ValueError:
+            print('\033[31m'+"Invalid number. Limits unchanged."+'\033[0m')
+            return
+    setRateLimits(limits[0], limits[2], limits[1], limits[3])
+    print('\033[32m'+"Rate limits updated."+'\033[0m')
+
+def seedPath(peer, path):
+    '''Seeds a file, or shares a whole directory tree.'''
+    if os.path.isdir(path):
+        peer.seedDirectory(path)
+        print(f"Now sharing {path}; files are announced as they are hashed...")
+    elif os.path.exists(path):
+        peer.registerSeeder(path)
+        print(f"Now seeding {path}...")
+    else:
+        print('\033[31m'+"File not found. Please enter a valid file."+'\033[0m')
+
+def seederMenu(peer):
     '''Main menu prompt after state change has occured(Leecher -> Seeder)'''
     while True:
-        action = input("\nSeeder Menu:\n1. Seed another file\n2. View active seeding files\n3. Verify downloaded file\n4. Exit\n> ").strip()
+        action = input("\nSeeder Menu:\n1. Seed another file or directory\n2. View active seeding files\n3. Verify downloaded file\n4. Set rate limits\n5. View statistics\n6. Exit\n> ").strip()
         
         if action == "1":
-            filename = input("\nEnter filename to seed: ").strip()
-            if os.path.exists(filename):
-                registerSeeder(filename)
-                print(f"Now seeding {filename}...")
-            else:
-                print('\033[31m'+"File not found. Please enter a valid file."+'\033[0m')
+            filename = input("\nEnter filename or directory to seed: ").strip()
+            seedPath(peer, filename)
         
         elif action == "2":
             
             print("\nCurrently seeding the following files:")
-            for filename in os.listdir('.'):
-                if os.path.isfile(filename) and (filename.startswith("[download]") or 
-                    filename in activeSeeds):
-                    print('\033[32m'+f"- {filename}"+'\033[0m')
+            # One bulk scrape shows how many seeders each file has
+            counts = peer.scrapeFiles(peer.seeds)
+            for filename in sorted(peer.seeds):
+                print('\033[32m'+f"- {filename} ({counts.get(filename, 0)} seeder(s))"+'\033[0m')
+            for shared in peer.directories:
+                state = "" if shared.scanned.is_set() else ", hashing"
+                print('\033[32m'+f"- {shared.directory}/ ({len(shared)} file(s){state})"+'\033[0m')
         
         elif action == "3":
             verifyDownloadedFile()
         
         elif action == "4":
+            rateLimitMenu()
+        
+        elif action == "5":
+            print(format_metrics(peer.stats()))
+        
+        elif action == "6":
             return  
         
         else:
-            print('\033[31m'+"\nInvalid option. Please choose 1, 2, 3, or 4."+'\033[0m')
+            print('\033[31m'+"\nInvalid option. Please choose 1, 2, 3, 4, 5, or 6."+'\033[0m')
 
-def leecherMenu():
+def leecherMenu(peer):
     '''Main menu prompt for leecher prior to becoming a seeder.'''
-    global boolSeeder
     while True:
         option = input("\nLeecher Menu: \n1. Download file \n2. Get list of seeders \n3. Verify downloaded file \n4. Back \n> ").strip()
         
         if option == "1":
             filename = input("\nEnter filename to download: ").strip()
-            success = downloadFile(filename)
-            if success:
-                
-                activeSeeds.append(f"downloaded_{filename}")
+            result = peer.downloadWithProgress(filename)
+            if result and result["ok"]:
                 return  
         
         elif option == "2":
             filename = input("\nEnter filename to check seeders: ").strip()
-            seederList(filename)
+            peer.seederList(filename)
         
         elif option == "3":
             verifyDownloadedFile()
@@ -322,20 +1021,16 @@ def leecherMenu():
         else:
             print('\033[31m'+"\nInvalid option. Please choose 1, 2, 3, or 4."+'\033[0m')
 
-if __name__ == "__main__":
-    
-    threading.Thread(target=startPeer, daemon=True).start()
-    time.sleep(1)
-    activeSeeds = []  # List to keep track of active seeders
-    while running:
-        if boolSeeder:
+def interactive(peer):
+    '''The interactive seeder/leecher menus.'''
+    while peer.running:
+        if peer.seeding:
             mode = input("\nChoose option:\n1. Seeder\n2. Exit\n> ").strip().lower()
             
             if mode == "1":
-                seederMenu()
+                seederMenu(peer)
             elif mode == "2":
-                exit()
-                running = False
+                peer.stop()
                 print('\033[31m'+"\nExiting..."+'\033[0m')
                 break
             else:
@@ -345,22 +1040,134 @@ if __name__ == "__main__":
             mode = input("\nChoose option:\n1. Seeder\n2. Leecher\n3. Exit\n> ").strip().lower()
 
             if mode == "1":
-                filename = input("\nEnter filename to seed: ").strip()
-                if os.path.exists(filename):
-                    registerSeeder(filename)
-                    activeSeeds.append(filename)
-                    print(f"Now seeding {filename}...")
-                else:
-                    print('\033[31m'+"\nFile not found. Please enter a valid file."+'\033[0m')
+                filename = input("\nEnter filename or directory to seed: ").strip()
+                seedPath(peer, filename)
 
             elif mode == "2":
-                leecherMenu()
+                leecherMenu(peer)
 
             elif mode == "3":
-                exit()
-                running = False
+                peer.stop()
                 print('\033[31m'+"\nExiting..."+'\033[0m')
                 break
 
             else:
-                print('\033[31m'+"\nInvalid option. Please choose 1, 2, or 3."+'\033[0m')
\ No newline at end of file
+                print('\033[31m'+"\nInvalid option. Please choose 1, 2, or 3."+'\033[0m')
+
+def serveForever(peer):
+    '''Keeps a seeding peer up until interrupted.'''
+    try:
+        while peer.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        peer.stop()
+        print('\033[31m'+"\nExiting..."+'\033[0m')
+
+def peerAddress(value):
+    '''argparse type for IP:PORT; bad input becomes a usage error instead of a traceback.'''
+    ip, _, port = value.rpartition(":")
+    if not ip or not port.isdigit() or not 0 < int(port) < 65536:
+        raise argparse.ArgumentTypeError(f"expected IP:PORT, got '{value}'")
+    return ip, int(port)
+
+def parseArguments(argv=None):
+    parser = argparse.ArgumentParser(description="Peer-to-peer file sharing client. Without a command, starts the interactive menus.")
+    parser.add_argument("--tracker", default=TRACKER_IP, help="tracker address (default: %(default)s)")
+    parser.add_argument("--tracker-port", type=int, default=TRACKER_PORT, help="tracker UDP port (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=PEER_PORT, help="port to serve other peers on (default: any free port)")
+    parser.add_argument("--profile", metavar="PATH", help="profile serving, downloading and hashing and write pstats to PATH on exit")
+    commands = parser.add_subparsers(dest="command")
+
+    seed = commands.add_parser("seed", help="share files and directories until interrupted")
+    seed.add_argument("paths", nargs="+", metavar="PATH", help="file or directory to share")
+    seed.add_argument("--rescan", type=float, default=RESCAN_INTERVAL, metavar="SECONDS",
+                      help="rescan shared directories this often, 0 for never (default: %(default)s)")
+
+    get = commands.add_parser("get", help="download files, several at a time")
+    get.add_argument("filenames", nargs="+", metavar="FILE", help="name of the file on the network")
+    get.add_argument("-o", "--output-dir", help="save files here under their own names (default: [download]FILE in the working directory)")
+    get.add_argument("-j", "--jobs", type=int, default=DOWNLOAD_WORKERS, help="files downloaded at once (default: %(default)s)")
+    get.add_argument("--seed", action="store_true", help="keep seeding the downloaded files until interrupted")
+    get.add_argument("--json", action="store_true", help="print results as JSON on stdout; messages go to stderr")
+
+    listing = commands.add_parser("list", help="show the seeders of files")
+    listing.add_argument("filenames", nargs="+", metavar="FILE")
+    listing.add_argument("--json", action="store_true", help="print seeders as JSON on stdout; messages go to stderr")
+
+    stats = commands.add_parser("stats", help="show the tracker's metrics, or another peer's")
+    stats.add_argument("peer", nargs="?", type=peerAddress, metavar="IP:PORT", help="peer to ask instead of the tracker")
+    stats.add_argument("--json", action="store_true", help="print metrics as JSON on stdout; messages go to stderr")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    '''Command line entry point; returns the process exit status.'''
+    args = parseArguments(argv)
+    as_json = getattr(args, "json", False)
+    if args.profile:
+        enable_profiling(args.profile)
+    peer = Peer(args.tracker, args.tracker_port, args.port)
+    # With --json only the results go to stdout, so they can be piped into another program
+    with contextlib.redirect_stdout(sys.stderr) if as_json else contextlib.nullcontext():
+        peer.start()
+
+        if args.command is None:
+            interactive(peer)
+            return 0
+
+        if args.command == "seed":
+            files = [path for path in args.paths if os.path.isfile(path)]
+            for path in args.paths:
+                if os.path.isdir(path):
+                    peer.seedDirectory(path, args.rescan or None)
+                elif not os.path.isfile(path):
+                    print('\033[31m'+f"File not found: {path}"+'\033[0m')
+            if files:
+                peer.seedFiles(files)
+            if not peer.seeds and not peer.directories:
+                peer.stop()
+                return 1
+            serveForever(peer)
+            return 0
+
+        if args.command == "stats":
+            if args.peer:
+                output = peer.peerStats(args.peer)
+            else:
+                output = peer.trackerStats()
+            peer.stop()
+            status = 0 if output else 1
+            if output and not as_json:
+                print(format_metrics(output))
+        elif args.command == "list":
+            listing = {filename: [{"ip": peer_info.get("ip"), "port": peer_info.get("port"), "hash": peer_info.get("hash")}
+                                  for peer_info in peer.seederList(filename) if isinstance(peer_info, dict)]
+                       for filename in args.filenames}
+            peer.stop()
+            output = listing
+            status = 0 if all(listing.values()) else 1
+        else:
+            if len(args.filenames) == 1 and not as_json:
+                results = [peer.downloadFile(args.filenames[0], os.path.join(args.output_dir, args.filenames[0]) if args.output_dir else None)]
+            else:
+                results = peer.downloadFiles(args.filenames, args.output_dir, args.jobs)
+            for result in results:
+                color = '\033[32m' if result["ok"] else '\033[31m'
+                outcome = f"{format_bytes(result['bytes'])} in {result['seconds']:.1f}s" if result["ok"] else result["error"]
+                print(color+f"{result['filename']}: {outcome}"+'\033[0m')
+            output = results
+            status = 0 if all(result["ok"] for result in results) else 1
+            if not (args.seed and peer.seeds):
+                peer.stop()
+
+    if as_json:
+        print(json.dumps(output, indent=2), flush=True)
+    if peer.running:
+        # get --seed: keep sharing the downloads
+        with contextlib.redirect_stdout(sys.stderr) if as_json else contextlib.nullcontext():
+            serveForever(peer)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,595 @@
+import socket
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from HashUtils import piece_range, verify_piece
+from PeerProtocol import encode_message, recv_message, recv_exact, recv_into_exact, unpack_bitfield
+from RateLimit import download_limits
+from Metrics import profiled
+
+
+PEER_TIMEOUT = 10  # Seconds before a silent seeder is treated as failed
+MAX_PEER_WORKERS = 16  # Upper bound on seeders downloaded from at once
+MAX_PEER_FAILURES = 3  # Failed pieces after which a seeder is dropped
+PROGRESS_SUFFIX = '.progress'  # Sidecar next to a partial download listing finished pieces
+PARTIAL_SUFFIX = '.part'  # Downloads are written here and renamed into place once complete
+PROGRESS_INTERVAL = 1.0  # Minimum seconds between sidecar rewrites
+PIPELINE_DEPTH = 4  # Requests sent to a seeder before waiting for the first reply
+MAX_IN_FLIGHT_BYTES = 4 * 1024 * 1024  # Piece bytes a worker asks one seeder for at once, and buffers
+MAX_BUFFERED_PIECE = 4 * 1024 * 1024  # Larger pieces are received in chunks straight into the file
+RECEIVE_CHUNK = 256 * 1024  # Chunk size for pieces received straight into the file
+MAX_IDLE_CONNECTIONS = 4  # Idle keep-alive connections kept per seeder
+IDLE_TIMEOUT = 20  # Seconds an idle pooled connection is kept; seeders close theirs after 30
+BUSY_BACKOFF = 0.5  # Seconds before asking a busy seeder again
+HAVE_REFRESH_INTERVAL = 1.0  # Seconds between bitfield refreshes for seeders that are still downloading
+ENDGAME_REQUESTS = 3  # Seeders asked for the same piece once every missing piece has been requested
+STALL_TIMEOUT = 30  # Seconds without a finished piece before workers with nothing to fetch give up
+
+
+def progress_path(output_path):
+    '''Path of the sidecar progress file for a partial download.'''
+    return output_path + PROGRESS_SUFFIX
+
+
+def partial_path(output_path):
+    '''Path of the temporary file a download is written to before it is renamed to `output_path`.'''
+    return output_path + PARTIAL_SUFFIX
+
+
+def preallocate(f, size):
+    '''Reserves `size` bytes for an open file up front, so pieces written at any offset land in
+    contiguous blocks instead of fragmenting the file. Falls back to a sparse truncate.'''
+    f.truncate(size)
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass  # Filesystem without fallocate support; the sparse file still works
+
+
+def write_at(f, data, offset):
+    '''Writes a buffer at an offset of an open file without moving a shared file position.'''
+    if hasattr(os, 'pwrite'):
+        written = 0
+        while written < len(data):
+            written += os.pwrite(f.fileno(), data[written:], offset + written)
+    else:
+        f.seek(offset)
+        f.write(data)
+        f.flush()
+
+
+def remove_partial(output_path):
+    '''Deletes a download's temporary file and progress sidecar.'''
+    clear_progress(output_path)
+    try:
+        os.remove(partial_path(output_path))
+    except OSError:
+        pass
+
+
+def load_progress(output_path, manifest):
+    '''Returns the set of pieces already on disk for this manifest, or an empty set if there is nothing to resume.'''
+    try:
+        with open(progress_path(output_path)) as f:
+            progress = json.load(f)
+        if (progress.get("root_hash") != manifest["root_hash"]
+                or progress.get("size") != manifest["size"]
+                or progress.get("piece_size") != manifest["piece_size"]
+                or os.path.getsize(partial_path(output_path)) != manifest["size"]):
+            return set()
+        return {index for index in progress.get("done", []) if 0 <= index < len(manifest["pieces"])}
+    except (OSError, ValueError, KeyError, TypeError):
+        return set()
+
+
+def save_progress(output_path, manifest, done):
+    '''Atomically records which pieces are on disk so the download can resume after a crash or restart.'''
+    path = progress_path(output_path)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({
+            "root_hash": manifest["root_hash"],
+            "size": manifest["size"],
+            "piece_size": manifest["piece_size"],
+            "done": sorted(done)
+        }, f)
+    os.replace(path + '.tmp', path)
+
+
+def clear_progress(output_path):
+    '''Removes the sidecar once a download has finished.'''
+    try:
+        os.remove(progress_path(output_path))
+    except OSError:
+        pass
+
+
+active_downloads = {}  # { realpath of output file: SwarmDownload } for downloads in progress
+active_lock = threading.Lock()
+
+
+def available_pieces(path):
+    '''Returns None if `path` is a complete file, or (piece_size, {finished piece indexes}) while it is
+    still being downloaded, so partial files can be served piece by piece.'''
+    with active_lock:
+        download = active_downloads.get(os.path.realpath(path))
+    if download is not None:
+        with download.lock:
+            return download.manifest["piece_size"], set(download.done)
+    try:
+        with open(progress_path(path)) as f:
+            progress = json.load(f)
+        return int(progress["piece_size"]), set(progress["done"])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0, set()  # Unreadable sidecar: treat the file as having nothing yet
+
+
+def range_available(available, offset, length):
+    '''Checks whether every piece overlapping a byte range is finished, given available_pieces().'''
+    if available is None or length == 0:
+        return True
+    piece_size, done = available
+    if piece_size <= 0:
+        return False
+    return all(index in done for index in range(offset // piece_size, (offset + length - 1) // piece_size + 1))
+
+
+class SeederBusy(ConnectionError):
+    '''Raised when a seeder has no upload slot free; the request can be retried later or elsewhere.'''
+
+
+class PieceMissing(ConnectionError):
+    '''Raised when a seeder that is still downloading does not have a requested piece yet.'''
+
+
+class ConnectionPool:
+    '''
+    Keep-alive TCP connections to seeders, keyed by (ip, port).
+
+    A connection goes back to the pool after its replies have been read in
+    full, so the next request to that seeder skips the TCP handshake. A
+    connection that failed mid-reply is closed instead, since the stream may
+    be out of step with the framing.
+    '''
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS, idle_timeout=IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}  # { (ip, port): [(sock, released_at), ...] }
+
+    def acquire(self, peer):
+        '''Returns (sock, reused): an idle connection to the peer if there is a fresh one, else a new connection.'''
+        now = time.time()
+        with self.lock:
+            connections = self.idle.get(peer, [])
+            while connections:
+                sock, released_at = connections.pop()
+                if now - released_at < self.idle_timeout:
+                    return sock, True
+                sock.close()
+        return self.connect(peer), False
+
+    def connect(self, peer):
+        '''Opens a new connection to the peer.'''
+        sock = socket.create_connection(peer, timeout=PEER_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def release(self, peer, sock):
+        '''Hands a connection whose replies were all read back for reuse.'''
+        with self.lock:
+            connections = self.idle.setdefault(peer, [])
+            if len(connections) < self.max_idle:
+                connections.append((sock, time.time()))
+                return
+        sock.close()
+
+    def close(self):
+        '''Closes every idle connection.'''
+        with self.lock:
+            for connections in self.idle.values():
+                for sock, _ in connections:
+                    sock.close()
+            self.idle.clear()
+
+connection_pool = ConnectionPool()
+
+
+def fetch_ranges(peer, requests, pool=None, into=None, sink=None, chunk=None, partial=False):
+    '''
+    Fetches several ranges from one seeder over a pooled connection and
+    returns [(header, data), ...] in request order.
+
+    All requests are written before the first reply is read, so the seeder
+    streams replies back to back instead of waiting a round trip for each.
+    `requests` is a list of dicts like {"filename", "offset", "length"}; leave
+    out offset and length to fetch a whole file. `into` may give a writable
+    buffer per request, exactly as long as the range; the data is then
+    received straight into it and the buffer is returned as the data.
+    Alternatively `sink(request_index, position, view)` is handed each range
+    a chunk at a time, received into the reusable `chunk` buffer, and the
+    data is returned as None, so any range size needs only one chunk of memory.
+    With `partial`, an error or missing reply (which has no body) does not
+    abort the batch: it is returned as (header, None) and the other replies
+    are still read. A busy seeder drops the connection, so that always raises.
+    '''
+    pool = pool or connection_pool
+    frames = b"".join(encode_message(dict(request, id=i)) for i, request in enumerate(requests))
+    sock, reused = pool.acquire(peer)
+    try:
+        try:
+            sock.sendall(frames)
+            header = recv_message(sock)
+        except (OSError, ValueError):
+            if not reused:
+                raise
+            # The seeder closed the idle connection in the meantime; retry once on a fresh one
+            sock.close()
+            sock = pool.connect(peer)
+            sock.sendall(frames)
+            header = recv_message(sock)
+        limiter = download_limits.connection(sock)  # Charged only while a download limit is set
+        replies = []
+        while True:
+            if header.get("status") == "busy":
+                raise SeederBusy(header.get("message", "Seeder busy"))  # May come before the request was read, without an id
+            if header.get("id") != len(replies):
+                raise ConnectionError("Seeder reply out of order")
+            if partial and header.get("status") != "success":
+                replies.append((header, None))
+                if len(replies) == len(requests):
+                    break
+                header = recv_message(sock)
+                continue
+            if header.get("status") == "missing":
+                raise PieceMissing(header.get("message", "Piece not downloaded yet"))
+            if header.get("status") != "success":
+                raise ConnectionError(header.get("message", "Seeder refused range request"))
+            if sink is not None:
+                chunk = chunk if chunk is not None else memoryview(bytearray(RECEIVE_CHUNK))
+                position = 0
+                while position < header["length"]:
+                    view = chunk[:min(len(chunk), header["length"] - position)]
+                    recv_into_exact(sock, view, limiter)
+                    sink(len(replies), position, view)
+                    position += len(view)
+                data = None
+            elif into is None:
+                data = recv_exact(sock, header["length"], limiter=limiter)
+            elif header["length"] == len(into[len(replies)]):
+                data = recv_into_exact(sock, into[len(replies)], limiter)
+            else:
+                raise ConnectionError("Seeder sent a range of the wrong length")
+            replies.append((header, data))
+            if len(replies) == len(requests):
+                break
+            header = recv_message(sock)
+    except BaseException:
+        sock.close()
+        raise
+    pool.release(peer, sock)
+    return replies
+
+
+def fetch_files(peer, filenames, pool=None):
+    '''Fetches whole files from one seeder in a single pipelined batch; returns [data, ...] in order.
+    A file the seeder cannot send comes back as None without failing the rest of the batch.
+    Meant for many small files, where a connection and round trip per file would dominate. No hash
+    is asked for, which would cost the seeder a hash lookup per file: check the data against a manifest.'''
+    requests = [{"filename": filename} for filename in filenames]
+    return [data for _, data in fetch_ranges(peer, requests, pool, partial=True)]
+
+
+class SwarmDownload:
+    '''
+    Downloads the pieces of one manifest from every seeder at once.
+
+    Each seeder first says which pieces it has (a bitfield). Seeders that
+    are still downloading themselves are asked again as they go. Workers
+    ask their seeder for the rarest missing pieces first, so pieces few
+    seeders hold spread before those seeders leave, and fast seeders
+    naturally take on more pieces than slow ones. Once every missing piece
+    has been requested, endgame mode asks other seeders for the same pieces
+    as well and keeps whichever copy arrives first, so one slow seeder
+    cannot hold up the last piece. A piece that fails verification or times
+    out goes back for another seeder, and a seeder that keeps failing is
+    dropped. Pieces are written into a preallocated temporary file that is
+    renamed to the output path once complete, and finished pieces are
+    recorded in a sidecar progress file so an interrupted download picks up
+    where it stopped.
+    '''
+
+    def __init__(self, filename, manifest, peers, output_path, peer_filenames=None, progress=None):
+        self.filename = filename
+        self.progress = progress  # Optional Progress.TransferProgress fed with every verified piece
+        self.peer_filenames = peer_filenames or {}  # { peer: name that seeder shares the content under }
+        self.manifest = manifest
+        self.peers = list(peers)[:MAX_PEER_WORKERS]
+        self.output_path = output_path
+        self.partial_path = partial_path(output_path)  # Renamed to output_path once every piece is in
+        self.num_pieces = len(manifest["pieces"])
+        self.done = load_progress(output_path, manifest)
+        self.resumed = len(self.done)
+        self.missing = set(range(self.num_pieces)) - self.done  # Pieces nobody has delivered yet
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)  # Signalled whenever pieces finish, fail or are released
+        self.remaining = self.num_pieces - len(self.done)
+        self.last_saved = 0.0
+        self.last_progress = time.time()
+        self.live_workers = len(self.peers)
+        self.in_flight = {}  # { piece_index: {peer, ...} currently asked for it }
+        self.have = {}  # { peer: set of piece indexes, or None for a seeder with the whole file }
+        self.have_checked = {}  # { peer: time its bitfield was last fetched }
+        self.failed_by = {}  # { piece_index: {peer, ...} }
+        self.pieces_from = {peer: 0 for peer in self.peers}  # { peer: pieces delivered }
+        self.duplicates = 0  # Endgame copies that arrived after the piece was already written
+        # Piece hashes only vouch for the root hash, so the whole-file hash is checked too, fed in file order
+        self.file_hash = hashlib.new(manifest.get("algorithm", "sha256"))
+        self.hashed_pieces = 0  # Pieces at the start of the file already fed to file_hash
+        self.hash_lock = threading.Lock()
+        # Bound each worker's memory by bytes rather than pieces: pieces grow with the file
+        self.depth = max(1, min(PIPELINE_DEPTH, MAX_IN_FLIGHT_BYTES // manifest["piece_size"]))
+        self.streamed = manifest["piece_size"] > MAX_BUFFERED_PIECE
+
+    def _preallocate(self):
+        '''Create the temporary file at its final size so pieces can be written at their offsets.'''
+        if self.resumed:
+            return  # Keep the pieces already on disk
+        with open(self.partial_path, 'wb') as f:
+            preallocate(f, self.manifest["size"])
+        save_progress(self.output_path, self.manifest, self.done)
+
+    def _mark_done(self, peer, index, length):
+        '''Record a piece that has been written and flushed, rewriting the sidecar at most once per interval.'''
+        if self.progress:
+            self.progress.update(length, peer)
+        with self.changed:
+            self.done.add(index)
+            self.remaining -= 1
+            self.pieces_from[peer] += 1
+            now = time.time()
+            self.last_progress = now
+            if now - self.last_saved >= PROGRESS_INTERVAL:
+                self.last_saved = now
+                save_progress(self.output_path, self.manifest, self.done)
+            self.changed.notify_all()
+
+    def _hash_in_order(self, wait=False):
+        '''Feed the finished pieces at the front of the file to the whole-file hash, reading back
+        those that arrived out of order. Without `wait`, leaves it to a worker already doing this.'''
+        if not self.hash_lock.acquire(blocking=wait):
+            return
+        try:
+            with open(self.partial_path, 'rb') as f:
+                while True:
+                    with self.lock:
+                        if self.hashed_pieces not in self.done:
+                            return
+                    offset, length = piece_range(self.manifest, self.hashed_pieces)
+                    f.seek(offset)
+                    self.file_hash.update(f.read(length))
+                    self.hashed_pieces += 1
+        finally:
+            self.hash_lock.release()
+
+    def _release(self, peer, indexes, failed=False):
+        '''Take pieces out of flight for this seeder, remembering a failure so another seeder is preferred next time.'''
+        with self.changed:
+            for index in indexes:
+                requesters = self.in_flight.get(index)
+                if requesters is not None:
+                    requesters.discard(peer)
+                    if not requesters:
+                        del self.in_flight[index]
+                if failed:
+                    self.failed_by.setdefault(index, set()).add(peer)
+            self.changed.notify_all()
+
+    def _refresh_have(self, peer, filename):
+        '''Fetch the seeder's bitfield. Seeders with the whole file are asked once, the others at most once per interval.'''
+        with self.lock:
+            if peer in self.have and (self.have[peer] is None
+                                      or time.time() - self.have_checked[peer] < HAVE_REFRESH_INTERVAL):
+                return
+        [(header, _)] = fetch_ranges(peer, [{"action": "have", "filename": filename, "offset": 0, "length": 0}])
+        if header.get("complete", True):
+            have = None  # Whole file, or a seeder that predates bitfields and only serves whole files
+        elif header.get("piece_size") == self.manifest["piece_size"]:
+            have = unpack_bitfield(header.get("pieces", ""), self.num_pieces)
+        else:
+            have = set()  # Pieces laid out differently; nothing usable
+        with self.changed:
+            self.have[peer] = have
+            self.have_checked[peer] = time.time()
+            self.changed.notify_all()
+
+    def _availability(self, index):
+        '''Number of connected seeders that have a piece.'''
+        return sum(1 for have in self.have.values() if have is None or index in have)
+
+    def _pick(self, peer):
+        '''Choose the next piece to ask this seeder for and mark it in flight; None if it has nothing useful right now.
+        Called with the lock held.'''
+        have = self.have.get(peer)
+
+        def usable(index):
+            if have is not None and index not in have:
+                return False
+            tried_by = self.failed_by.get(index, ())
+            # Leave a piece this seeder already failed to one that has not tried it yet
+            return peer not in tried_by or len(tried_by) >= self.live_workers
+
+        fresh = [index for index in self.missing if index not in self.in_flight and usable(index)]
+        if fresh:
+            # Rarest first, ties broken at random so seeders do not all chase the same piece
+            index = min(fresh, key=lambda index: (self._availability(index), random.random()))
+        elif not self.streamed and all(index in self.in_flight for index in self.missing):
+            # (Streamed pieces are written as they arrive, so a piece must only ever have one writer)
+            # Endgame: everything left has been asked for, so race the slower seeders for it
+            racing = [index for index in self.missing
+                      if peer not in self.in_flight[index] and len(self.in_flight[index]) < ENDGAME_REQUESTS and usable(index)]
+            if not racing:
+                return None
+            index = min(racing, key=lambda index: (len(self.in_flight[index]), random.random()))
+        else:
+            return None  # The pieces still unrequested are ones this seeder does not have
+        self.in_flight.setdefault(index, set()).add(peer)
+        return index
+
+    def _next_batch(self, peer, filename):
+        '''Wait for up to `depth` pieces to ask this seeder for; empty once the download is over or has stalled.'''
+        while True:
+            self._refresh_have(peer, filename)
+            with self.changed:
+                if not self.missing:
+                    return []
+                batch = []
+                while len(batch) < self.depth:
+                    index = self._pick(peer)
+                    if index is None:
+                        break
+                    batch.append(index)
+                if batch:
+                    return batch
+                if time.time() - self.last_progress > STALL_TIMEOUT:
+                    return []  # Nobody is delivering the pieces that are left
+                self.changed.wait(HAVE_REFRESH_INTERVAL)
+
+    @profiled
+    def _peer_worker(self, peer):
+        failures = 0
+        filename = self.peer_filenames.get(peer, self.filename)
+        algorithm = self.manifest.get("algorithm", "sha256")
+        # Pieces are received into this buffer, verified there and written to their offset, so
+        # the worker allocates nothing per piece. Pieces too big to buffer are received a chunk at
+        # a time, hashed as they go and written straight to their place in the file
+        buffer = memoryview(bytearray(RECEIVE_CHUNK if self.streamed else self.depth * self.manifest["piece_size"]))
+        try:
+            with open(self.partial_path, 'r+b') as f:
+                while failures < MAX_PEER_FAILURES:
+                    try:
+                        batch = self._next_batch(peer, filename)
+                    except Exception as e:
+                        failures += 1
+                        print('\033[33m'+f"Could not get piece list from {peer[0]}:{peer[1]} ({e})."+'\033[0m')
+                        time.sleep(BUSY_BACKOFF)
+                        continue
+                    if not batch:
+                        return
+                    requests, views = [], []
+                    for slot, index in enumerate(batch):
+                        offset, length = piece_range(self.manifest, index)
+                        requests.append({"filename": filename, "offset": offset, "length": length})
+                        start = slot * self.manifest["piece_size"]
+                        views.append(buffer[start:start + length])
+                    hashers = [hashlib.new(algorithm) for _ in batch] if self.streamed else None
+
+                    def sink(slot, position, view):
+                        hashers[slot].update(view)
+                        write_at(f, view, requests[slot]["offset"] + position)
+
+                    try:
+                        if self.streamed:
+                            replies = fetch_ranges(peer, requests, sink=sink, chunk=buffer)
+                        else:
+                            replies = fetch_ranges(peer, requests, into=views)
+                    except (SeederBusy, PieceMissing) as e:
+                        # Not the seeder's fault: let other seeders take the pieces and try again shortly
+                        self._release(peer, batch)
+                        if isinstance(e, PieceMissing):
+                            with self.lock:
+                                self.have_checked[peer] = 0.0  # Our view of its pieces is stale
+                        time.sleep(BUSY_BACKOFF)
+                        continue
+                    except Exception as e:
+                        failures += 1
+                        self._release(peer, batch, failed=True)
+                        print('\033[33m'+f"Pieces {batch} from {peer[0]}:{peer[1]} failed ({e}). Requeued."+'\033[0m')
+                        continue
+                    for slot, (index, request, (_, data)) in enumerate(zip(batch, requests, replies)):
+                        with self.lock:
+                            needed = index in self.missing
+                        if self.streamed:
+                            intact = hashers[slot].hexdigest() == self.manifest["pieces"][index].lower()
+                        else:
+                            intact = verify_piece(data, self.manifest["pieces"][index], algorithm)
+                        if needed and not intact:
+                            failures += 1
+                            self._release(peer, [index], failed=True)
+                            print('\033[33m'+f"Piece {index} from {peer[0]}:{peer[1]} failed verification. Requeued."+'\033[0m')
+                            continue
+                        with self.lock:
+                            # In endgame another seeder may have delivered this piece in the meantime
+                            claimed = index in self.missing
+                            self.missing.discard(index)
+                            if not claimed:
+                                self.duplicates += 1
+                        if claimed:
+                            # Written before the sidecar can list the piece
+                            if not self.streamed:
+                                write_at(f, data, request["offset"])
+                            self._mark_done(peer, index, request["length"])
+                            self._hash_in_order()
+                        self._release(peer, [index])
+            print('\033[31m'+f"Dropping seeder {peer[0]}:{peer[1]} after {failures} failed pieces."+'\033[0m')
+        finally:
+            with self.changed:
+                self.live_workers -= 1
+                self.have.pop(peer, None)  # No longer counts towards piece availability
+                self.changed.notify_all()
+
+    def run(self):
+        '''Download every piece; returns True once all pieces are written and verified.'''
+        if not self.peers:
+            return False
+        self._preallocate()
+        if self.resumed:
+            print('\033[33m'+f"Resuming: {self.resumed}/{self.num_pieces} pieces already downloaded."+'\033[0m')
+        key = os.path.realpath(self.output_path)
+        with active_lock:
+            active_downloads[key] = self  # Lets our own seeder serve the pieces we already have
+        start = time.time()
+        if self.progress:
+            self.progress.start(self.manifest["size"], sum(piece_range(self.manifest, index)[1] for index in self.done))
+        try:
+            for peer in self.peers:
+                threading.Thread(target=self._peer_worker, args=(peer,), daemon=True).start()
+            # Return as soon as the last piece is written; a slow seeder still busy with a
+            # duplicate endgame request finishes in the background and its copy is discarded
+            with self.changed:
+                while self.remaining and self.live_workers:
+                    self.changed.wait()
+            elapsed = max(time.time() - start, 1e-6)
+
+            if self.remaining:
+                save_progress(self.output_path, self.manifest, self.done)
+                return False
+            self._hash_in_order(wait=True)
+            if self.hashed_pieces < self.num_pieces or self.file_hash.hexdigest() != self.manifest["hash"]:
+                # Every piece matched the manifest, so the manifest itself does not match its hash
+                print('\033[31m'+f"Manifest for {self.filename} does not match its file hash. Discarding the download."+'\033[0m')
+                remove_partial(self.output_path)
+                self.done = set()
+                return False
+            # Only a complete, verified file ever appears under the real name
+            os.replace(self.partial_path, self.output_path)
+            clear_progress(self.output_path)
+        finally:
+            with active_lock:
+                active_downloads.pop(key, None)
+            if self.progress:
+                self.progress.finish()
+        fetched = self.num_pieces - self.resumed
+        rate = fetched * self.manifest["piece_size"] / elapsed / (1024 * 1024)
+        print('\033[32m'+f"Fetched {fetched} pieces from {len(self.peers)} seeders at {rate:.2f} MB/s"+'\033[0m')
+        for (ip, port), count in self.pieces_from.items():
+            print(f"  {ip}:{port} - {count} pieces, {count * self.manifest['piece_size'] / elapsed / (1024 * 1024):.2f} MB/s")
+        if self.duplicates:
+            print(f"  {self.duplicates} duplicate endgame piece(s) discarded")
+        return True
@@ -1,14 +1,32 @@
 import hashlib
+import json
+import mmap
 import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Metrics import metrics, profiled
 
 
-def compute_file_hash(filename, algorithm='sha256'):
+PIECE_SIZE = 256 * 1024  # Smallest piece size used in manifests
+MAX_PIECES = 512  # Caps manifest size so it still fits in one tracker datagram
+HASH_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.p2p_hash_cache.sqlite')
+HASH_CACHE_MAX_ENTRIES = 10000  # Least recently used entries are evicted beyond this
+HASH_WORKERS = os.cpu_count() or 4  # Threads hashing in parallel; hashlib releases the GIL
+READ_SIZE = 1024 * 1024  # Read size for sequential hashing
+
+
+@metrics.timed("hash.compute_file_hash")
+def compute_file_hash(filename, algorithm='sha256', use_cache=True):
     """
     Compute the hash of a file using the specified algorithm.
+    SHA256 hashes come from the hash cache while the file is unchanged.
     
     Args:
         filename (str): Path to the file to hash
         algorithm (str): Hashing algorithm to use (default: 'sha256')
+        use_cache (bool): Look up and store the hash in the hash cache (default: True)
     
     Returns:
         str: Hexadecimal hash string of the file, or None if file doesn't exist
@@ -16,13 +34,21 @@ def compute_file_hash(filename, algorithm='sha256'):
     if not os.path.exists(filename):
         return None
     
+    if use_cache and algorithm == 'sha256':
+        # The manifest carries the whole-file hash and is cached with it
+        manifest = build_manifest(filename)
+        return manifest['hash'] if manifest else None
+    
     hash_obj = hashlib.new(algorithm)
     
     try:
         with open(filename, 'rb') as f:
-            # Read file in chunks to handle large files
-            while chunk := f.read(8192):
-                hash_obj.update(chunk)
+            # Read file in large chunks into one reused buffer
+            buffer = bytearray(READ_SIZE)
+            view = memoryview(buffer)
+            while read := f.readinto(buffer):
+                hash_obj.update(view[:read])
+                metrics.incr("hash.bytes", read)
         return hash_obj.hexdigest()
     except Exception as e:
         print(f'\033[31m'f"Error computing hash for {filename}: {e}"+'\033[0m')
@@ -45,11 +71,27 @@ def verify_file_integrity(filename, expected_hash, algorithm='sha256'):
         print('\033[31m'+f"Error: File {filename} not found."+'\033[0m')
         return False
     
-    computed_hash = compute_file_hash(filename, algorithm)
+    # Always read the bytes: a cached hash cannot vouch for what is on disk
+    computed_hash = compute_file_hash(filename, algorithm, use_cache=False)
     
     if computed_hash is None:
         return False
     
+    return report_integrity(filename, expected_hash, computed_hash)
+
+
+def report_integrity(filename, expected_hash, computed_hash):
+    """
+    Compare a computed hash with the expected one and print the verdict.
+    
+    Args:
+        filename (str): Path to the file the hash belongs to
+        expected_hash (str): Expected hash value (hexadecimal string)
+        computed_hash (str): Hash computed from the file's contents
+    
+    Returns:
+        bool: True if hashes match (file is intact), False otherwise
+    """
     if computed_hash.lower() == expected_hash.lower():
         print('\033[32m'+f"✓ File integrity verified: {filename}"+'\033[0m')
         return True
@@ -60,6 +102,33 @@ def verify_file_integrity(filename, expected_hash, algorithm='sha256'):
         return False
 
 
+class StreamVerifier:
+    """
+    Hashes a file while it is being written, so the integrity verdict is ready
+    the moment the last byte arrives instead of after a second full read.
+    """
+    
+    def __init__(self, expected_hash, algorithm='sha256'):
+        self.expected_hash = expected_hash
+        self._hash_obj = hashlib.new(algorithm)
+    
+    def update(self, data):
+        """Feed the next bytes written to the file, in order."""
+        self._hash_obj.update(data)
+    
+    def verify(self, filename):
+        """
+        Compare the hash of everything fed so far with the expected hash.
+        
+        Args:
+            filename (str): Path of the file being verified, for reporting
+        
+        Returns:
+            bool: True if hashes match (file is intact), False otherwise
+        """
+        return report_integrity(filename, self.expected_hash, self._hash_obj.hexdigest())
+
+
 def get_file_info(filename):
     """
     Get file information including name, size, and hash.
@@ -86,3 +155,420 @@ def get_file_info(filename):
     except Exception as e:
         print(f'\033[31m'f"Error getting file info for {filename}: {e}"+'\033[0m')
         return None
+
+
+def choose_piece_size(file_size):
+    """
+    Pick a power-of-two piece size that keeps the piece count within MAX_PIECES.
+    
+    Args:
+        file_size (int): Size of the file in bytes
+    
+    Returns:
+        int: Piece size in bytes
+    """
+    piece_size = PIECE_SIZE
+    while piece_size * MAX_PIECES < file_size:
+        piece_size *= 2
+    return piece_size
+
+
+def compute_root_hash(piece_hashes, algorithm='sha256'):
+    """
+    Compute the root hash of a manifest from its piece hashes.
+    
+    Args:
+        piece_hashes (list): Hexadecimal hash of every piece, in order
+        algorithm (str): Hashing algorithm to use (default: 'sha256')
+    
+    Returns:
+        str: Hexadecimal hash over the concatenated piece digests
+    """
+    hash_obj = hashlib.new(algorithm)
+    for piece_hash in piece_hashes:
+        hash_obj.update(bytes.fromhex(piece_hash))
+    return hash_obj.hexdigest()
+
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def get_hash_pool():
+    """
+    Get the shared thread pool that hashes pieces, creating it on first use.
+    Tasks in this pool never wait on other tasks, so any thread may submit to it.
+    
+    Returns:
+        ThreadPoolExecutor: The shared pool
+    """
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hash')
+        return _hash_pool
+
+
+def _hash_mapped_range(mapped, offset, length, algorithm):
+    """Hash a slice of a memory-mapped file without copying it."""
+    with memoryview(mapped) as view, view[offset:offset + length] as piece:
+        return hashlib.new(algorithm, piece).hexdigest()
+
+
+@profiled
+def build_manifest(filename, piece_size=None, algorithm='sha256', use_cache=True):
+    """
+    Build a torrent-style manifest for a file: fixed-size pieces, a hash per
+    piece, a root hash over the pieces and the hash of the whole file.
+    The file is memory-mapped: pieces are hashed concurrently on the shared
+    hash pool while this thread computes the whole-file hash, and default
+    manifests are kept in the hash cache so an unchanged file is never read again.
+    
+    Args:
+        filename (str): Path to the file
+        piece_size (int): Piece size in bytes (default: chosen from the file size)
+        algorithm (str): Hashing algorithm to use (default: 'sha256')
+        use_cache (bool): Look up and store the manifest in the hash cache (default: True)
+    
+    Returns:
+        dict: The manifest, or None if the file doesn't exist
+    """
+    if not os.path.exists(filename):
+        return None
+    
+    cacheable = use_cache and piece_size is None and algorithm == 'sha256'
+    if cacheable:
+        cached = get_hash_cache().get(filename)
+        if cached is not None:
+            metrics.incr("hash.cache_hits")
+            return cached
+        metrics.incr("hash.cache_misses")
+    
+    try:
+        started = time.perf_counter()
+        stat_before = os.stat(filename)
+        size = stat_before.st_size
+        if piece_size is None:
+            piece_size = choose_piece_size(size)
+        
+        file_hash_obj = hashlib.new(algorithm)
+        pieces = []
+        if size > 0:
+            with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                size = len(mapped)
+                pool = get_hash_pool()
+                futures = [pool.submit(_hash_mapped_range, mapped, offset, piece_size, algorithm)
+                           for offset in range(0, size, piece_size)]
+                with memoryview(mapped) as view:
+                    file_hash_obj.update(view)
+                pieces = [future.result() for future in futures]
+        metrics.observe("hash.build_manifest", time.perf_counter() - started)
+        metrics.incr("hash.bytes", size)
+        
+        manifest = {
+            'filename': os.path.basename(filename),
+            'size': size,
+            'piece_size': piece_size,
+            'pieces': pieces,
+            'root_hash': compute_root_hash(pieces, algorithm),
+            'hash': file_hash_obj.hexdigest(),
+            'algorithm': algorithm
+        }
+        # Only cache if the file did not change while it was being read
+        if cacheable and stat_signature(os.stat(filename)) == stat_signature(stat_before):
+            get_hash_cache().put(filename, manifest, stat_before)
+        return manifest
+    except Exception as e:
+        print(f'\033[31m'f"Error building manifest for {filename}: {e}"+'\033[0m')
+        return None
+
+
+def build_manifests(filenames, use_cache=True, workers=HASH_WORKERS):
+    """
+    Build manifests for many files at once, hashing several files in parallel.
+    
+    Args:
+        filenames (list): Paths of the files to hash
+        use_cache (bool): Look up and store manifests in the hash cache (default: True)
+        workers (int): Number of files hashed at the same time (default: HASH_WORKERS)
+    
+    Returns:
+        dict: { filename: manifest } for every file that could be hashed
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hash-file') as pool:
+        manifests = pool.map(lambda name: build_manifest(name, use_cache=use_cache), filenames)
+        return {name: manifest for name, manifest in zip(filenames, manifests) if manifest is not None}
+
+
+def hash_directory(directory, recursive=True, use_cache=True, workers=HASH_WORKERS):
+    """
+    Build manifests for every regular file in a directory.
+    
+    Args:
+        directory (str): Directory to hash
+        recursive (bool): Include files in subdirectories (default: True)
+        use_cache (bool): Look up and store manifests in the hash cache (default: True)
+        workers (int): Number of files hashed at the same time (default: HASH_WORKERS)
+    
+    Returns:
+        dict: { path: manifest } for every file that could be hashed
+    """
+    filenames = []
+    pending = [directory]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    filenames.append(entry.path)
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+    return build_manifests(filenames, use_cache=use_cache, workers=workers)
+
+
+def verify_manifest(manifest):
+    """
+    Check that a manifest is self-consistent: the piece count matches the file
+    size and the root hash matches the piece hashes.
+    
+    Args:
+        manifest (dict): Manifest as returned by build_manifest
+    
+    Returns:
+        bool: True if the manifest can be trusted to verify pieces
+    """
+    try:
+        size = manifest['size']
+        piece_size = manifest['piece_size']
+        pieces = manifest['pieces']
+        algorithm = manifest.get('algorithm', 'sha256')
+        if piece_size <= 0 or len(pieces) != -(-size // piece_size):
+            return False
+        return compute_root_hash(pieces, algorithm) == manifest['root_hash']
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def piece_range(manifest, index):
+    """
+    Get the byte range covered by a piece.
+    
+    Args:
+        manifest (dict): Manifest as returned by build_manifest
+        index (int): Piece index
+    
+    Returns:
+        tuple: (offset, length) of the piece within the file
+    """
+    offset = index * manifest['piece_size']
+    return offset, min(manifest['piece_size'], manifest['size'] - offset)
+
+
+def verify_piece(data, expected_hash, algorithm='sha256'):
+    """
+    Verify a single piece against its expected hash.
+    
+    Args:
+        data (bytes): Contents of the piece
+        expected_hash (str): Expected hash value (hexadecimal string)
+        algorithm (str): Hashing algorithm used (default: 'sha256')
+    
+    Returns:
+        bool: True if the piece is intact
+    """
+    return hashlib.new(algorithm, data).hexdigest() == expected_hash.lower()
+
+
+class PieceVerifier:
+    """
+    Verifies the pieces of a manifest while a file streams in, so a corrupt
+    piece is caught as soon as it completes instead of after the whole transfer.
+    """
+    
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.algorithm = manifest.get('algorithm', 'sha256')
+        self.index = 0  # Piece currently being received
+        self.filled = 0  # Bytes received for the current piece
+        self.failed_piece = None  # Index of the first piece that failed
+        self._hash_obj = hashlib.new(self.algorithm)
+    
+    def _check_piece(self):
+        if self._hash_obj.hexdigest() != self.manifest['pieces'][self.index]:
+            self.failed_piece = self.index
+            return False
+        self.index += 1
+        self.filled = 0
+        self._hash_obj = hashlib.new(self.algorithm)
+        return True
+    
+    def update(self, data):
+        """
+        Feed the next received bytes.
+        
+        Returns:
+            bool: False as soon as a completed piece fails verification
+        """
+        if self.failed_piece is not None:
+            return False
+        view = memoryview(data)
+        while view:
+            if self.index >= len(self.manifest['pieces']):
+                self.failed_piece = self.index  # More data than the manifest describes
+                return False
+            _, length = piece_range(self.manifest, self.index)
+            take = min(length - self.filled, len(view))
+            self._hash_obj.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == length and not self._check_piece():
+                return False
+        return True
+    
+    def finish(self):
+        """
+        Confirm that every piece arrived and verified.
+        
+        Returns:
+            bool: True if the whole file matched the manifest
+        """
+        return self.failed_piece is None and self.index == len(self.manifest['pieces'])
+
+
+def stat_signature(st):
+    """
+    Fields of a stat result that change whenever a file's contents are replaced.
+    
+    Args:
+        st (os.stat_result): Result of os.stat
+    
+    Returns:
+        tuple: (size, mtime_ns, inode)
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class HashCache:
+    """
+    Persistent cache of manifests keyed on (path, size, mtime_ns, inode).
+    
+    Entries live in a small sqlite database so they survive restarts. An entry
+    is only returned while the file's size, mtime and inode still match, and
+    the least recently used entries are evicted beyond max_entries.
+    """
+    
+    def __init__(self, path=HASH_CACHE_PATH, max_entries=HASH_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL without a sync per commit keeps batch hashing of many files cheap
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS manifests ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "manifest TEXT, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS manifests_last_used ON manifests (last_used)")
+        self.db.commit()
+    
+    def get(self, filename):
+        """
+        Look up the manifest of an unchanged file.
+        
+        Args:
+            filename (str): Path to the file
+        
+        Returns:
+            dict: The cached manifest, or None on a miss or if the file changed
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        key = os.path.realpath(filename)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, inode, manifest FROM manifests WHERE path = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if tuple(row[:3]) != stat_signature(st):
+                # Stale entry: the file was modified or replaced
+                self.db.execute("DELETE FROM manifests WHERE path = ?", (key,))
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE manifests SET last_used = ? WHERE path = ?", (time.time(), key))
+            self.db.commit()
+        return json.loads(row[3])
+    
+    def put(self, filename, manifest, st=None):
+        """
+        Store the manifest of a file, evicting old entries if the cache is full.
+        
+        Args:
+            filename (str): Path to the file
+            manifest (dict): Manifest describing the file's current contents
+            st (os.stat_result): Stat taken before the file was hashed (default: stat now)
+        """
+        try:
+            st = st or os.stat(filename)
+        except OSError:
+            return
+        size, mtime_ns, inode = stat_signature(st)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.realpath(filename), size, mtime_ns, inode, json.dumps(manifest), time.time())
+            )
+            count = self.db.execute("SELECT COUNT(*) FROM manifests").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute(
+                    "DELETE FROM manifests WHERE path IN "
+                    "(SELECT path FROM manifests ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self.db.commit()
+    
+    def invalidate(self, filename):
+        """
+        Drop the cached entry for a file.
+        
+        Args:
+            filename (str): Path to the file
+        """
+        with self.lock:
+            self.db.execute("DELETE FROM manifests WHERE path = ?", (os.path.realpath(filename),))
+            self.db.commit()
+    
+    def clear(self):
+        """Drop every cached entry."""
+        with self.lock:
+            self.db.execute("DELETE FROM manifests")
+            self.db.commit()
+
+
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
+
+
+def get_hash_cache():
+    """
+    Get the process-wide hash cache, opening it on first use.
+    
+    Returns:
+        HashCache: The shared cache
+    """
+    global _hash_cache
+    with _hash_cache_lock:
+        if _hash_cache is None:
+            try:
+                _hash_cache = HashCache()
+            except sqlite3.Error as e:
+                # Keep caching for this run even if the cache file cannot be opened
+                print('\033[33m'+f"Warning: Hash cache unavailable ({e}). Using an in-memory cache."+'\033[0m')
+                _hash_cache = HashCache(':memory:')
+        return _hash_cache
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+
+
+BASE_PEER_PORT = 20000  # Simulated peers announce ports from here upwards
+REPLY_TIMEOUT = 2.0  # Seconds before a REQUEST without a reply counts as lost
+REGISTER_BATCH = 500  # REGISTERs sent before pausing, so setup does not overflow the tracker's queue
+
+
+class ReplyProtocol(asyncio.DatagramProtocol):
+    '''Hands the next datagram received to whoever is waiting for a reply.'''
+
+    def __init__(self):
+        self.waiter = None
+
+    def datagram_received(self, data, addr):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(data)
+
+
+def fakeHash(filename):
+    '''Stable stand-in for a file hash.'''
+    return hashlib.sha256(filename.encode()).hexdigest()
+
+
+def percentile(values, fraction):
+    '''Returns the value below which `fraction` of the sorted values fall.'''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def registerPeers(transport, num_peers, files, files_per_peer):
+    '''Registers every simulated peer as a seeder of a few random files.'''
+    sent = 0
+    for index in range(num_peers):
+        for filename in random.sample(files, min(files_per_peer, len(files))):
+            transport.sendto(json.dumps({
+                "action": "REGISTER",
+                "filename": filename,
+                "port": BASE_PEER_PORT + index,
+                "file_hash": fakeHash(filename)
+            }).encode())
+            sent += 1
+            if sent % REGISTER_BATCH == 0:
+                await asyncio.sleep(0.01)
+    return sent
+
+
+async def peerWorker(host, port, num_peers, files, deadline, request_ratio, latencies, counters):
+    '''Sends a mix of HEARTBEATs and REQUESTs, waiting for each REQUEST's reply before the next one.'''
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(ReplyProtocol, remote_addr=(host, port))
+    try:
+        while time.perf_counter() < deadline:
+            peer_port = BASE_PEER_PORT + random.randrange(num_peers)
+            if random.random() < request_ratio:
+                protocol.waiter = loop.create_future()
+                start = time.perf_counter()
+                transport.sendto(json.dumps({"action": "REQUEST", "filename": random.choice(files)}).encode())
+                try:
+                    await asyncio.wait_for(protocol.waiter, REPLY_TIMEOUT)
+                    latencies.append(time.perf_counter() - start)
+                    counters["requests"] += 1
+                except asyncio.TimeoutError:
+                    counters["lost"] += 1
+            else:
+                transport.sendto(json.dumps({"action": "HEARTBEAT", "port": peer_port}).encode())
+                counters["heartbeats"] += 1
+                await asyncio.sleep(0)
+    finally:
+        transport.close()
+
+
+async def runLoad(host, port, num_peers, num_files, files_per_peer, duration, concurrency, request_ratio):
+    '''Simulates `num_peers` peers against a running tracker and returns the measured rates and latencies.'''
+    loop = asyncio.get_running_loop()
+    files = [f"loadtest_{index}.bin" for index in range(num_files)]
+
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    start = time.perf_counter()
+    registered = await registerPeers(transport, num_peers, files, files_per_peer)
+    register_time = time.perf_counter() - start
+    transport.close()
+    await asyncio.sleep(0.5)  # Let the tracker drain the registrations
+
+    latencies = []
+    counters = {"requests": 0, "heartbeats": 0, "lost": 0}
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(peerWorker(host, port, num_peers, files, deadline, request_ratio, latencies, counters)
+                           for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "peers": num_peers,
+        "files": num_files,
+        "registers_sent": registered,
+        "register_send_rate": round(registered / max(register_time, 1e-9), 1),
+        "duration_s": round(elapsed, 2),
+        "requests_per_s": round(counters["requests"] / elapsed, 1),
+        "heartbeats_per_s": round(counters["heartbeats"] / elapsed, 1),
+        "messages_per_s": round((counters["requests"] + counters["heartbeats"]) / elapsed, 1),
+        "lost_requests": counters["lost"],
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate many peers against a running tracker.")
+    parser.add_argument("--host", default="127.0.0.1", help="Tracker address")
+    parser.add_argument("--port", type=int, default=5000, help="Tracker UDP port")
+    parser.add_argument("--peers", type=int, default=1000, help="Number of simulated peers")
+    parser.add_argument("--files", type=int, default=100, help="Number of distinct files")
+    parser.add_argument("--files-per-peer", type=int, default=3, help="Files each simulated peer seeds")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of mixed HEARTBEAT/REQUEST load")
+    parser.add_argument("--concurrency", type=int, default=32, help="Simultaneous outstanding REQUESTs")
+    parser.add_argument("--request-ratio", type=float, default=0.5, help="Fraction of messages that are REQUESTs")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(runLoad(args.host, args.port, args.peers, args.files, args.files_per_peer,
+                                  args.duration, args.concurrency, args.request_ratio))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print(f"{key:>20}: {value}")
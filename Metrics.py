@@ -0,0 +1,231 @@
+import atexit
+import bisect
+import collections
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+
+
+LATENCY_BUCKETS = [0.0001 * 2 ** i for i in range(20)]  # Histogram bucket upper bounds, 0.1 ms to ~52 s
+PROFILE_ENV = 'P2P_PROFILE'  # Set to a file path to profile the hot paths and write pstats there at exit
+PROFILE_TOP = 25  # Functions listed by print_profile
+
+
+class Histogram:
+    '''Latency histogram with fixed log-scale buckets; cheap to update and small to send.'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot counts values above the largest bucket
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, fraction):
+        '''Upper bound of the bucket holding the given fraction of observations.'''
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                bound = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max
+        }
+
+
+class Metrics:
+    '''
+    Counters, gauges and latency histograms for one process.
+
+    Counters only go up (requests, bytes, errors); gauges hold a current value
+    (open connections); histograms record how long operations take. Everything
+    is guarded by one lock, so any thread can record and snapshot() returns a
+    consistent, JSON-serialisable view.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_gauge(self, name, amount):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timed(self, name):
+        '''Decorator recording every call's duration under `name`, and profiling it when profiling is on.'''
+        def decorate(function):
+            profiled_function = profiled(function)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return profiled_function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return wrapper
+        return decorate
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: histogram.summary() for name, histogram in self.histograms.items()}
+            }
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds:.2f}s"
+
+
+def format_metrics(snapshot):
+    '''Renders a metrics snapshot as aligned text, with per-second rates for counters.'''
+    uptime = max(snapshot.get("uptime", 0), 1e-6)
+    lines = [f"uptime {uptime:.0f}s"]
+    for name, value in sorted(snapshot.get("counters", {}).items()):
+        lines.append(f"{name:<36} {value:>14,}  ({value / uptime:,.1f}/s)")
+    for name, value in sorted(snapshot.get("gauges", {}).items()):
+        lines.append(f"{name:<36} {value:>14,}")
+    for name, summary in sorted(snapshot.get("histograms", {}).items()):
+        lines.append(f"{name:<36} {summary['count']:>14,}  mean {format_duration(summary['mean'])}"
+                     f"  p50 {format_duration(summary['p50'])}  p90 {format_duration(summary['p90'])}"
+                     f"  p99 {format_duration(summary['p99'])}  max {format_duration(summary['max'])}")
+    return "\n".join(lines)
+
+
+# Profiling: off unless enabled, in which case every profiled call runs under
+# a per-thread cProfile.Profile and the results are merged when dumped.
+_profile_lock = threading.Lock()
+_profiles = []  # Every thread's Profile, for merging
+_profile_local = threading.local()
+_profile_path = None
+
+
+def enable_profiling(path=None):
+    '''Profile the hot paths from now on; with a path, the merged stats are written there at exit.'''
+    global _profile_path
+    first = _profile_path is None
+    _profile_path = path or _profile_path or ""
+    if first and path:
+        atexit.register(lambda: dump_profile(_profile_path))
+
+
+def profiled(function):
+    '''Runs the function under cProfile while profiling is enabled; a plain call otherwise.'''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profile_path is None or getattr(_profile_local, "active", False):
+            return function(*args, **kwargs)  # Off, or already inside a profiled call on this thread
+        profile = getattr(_profile_local, "profile", None)
+        if profile is None:
+            profile = _profile_local.profile = cProfile.Profile()
+            with _profile_lock:
+                _profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            return function(*args, **kwargs)  # Another profiler is active (Python 3.12+ allows one at a time)
+        _profile_local.active = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            _profile_local.active = False
+    return wrapper
+
+
+def profile_stats():
+    '''Merged pstats.Stats of every thread, or None if nothing was profiled.'''
+    with _profile_lock:
+        profiles = list(_profiles)
+    stats = None
+    for profile in profiles:
+        try:
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        except TypeError:
+            continue  # A profile that has not recorded anything yet
+    return stats
+
+
+def dump_profile(path):
+    '''Writes the merged profile to `path` (open it with pstats or snakeviz); returns False if there was nothing.'''
+    stats = profile_stats()
+    if stats is None or not path:
+        return False
+    stats.dump_stats(path)
+    return True
+
+
+def print_profile(limit=PROFILE_TOP, sort="cumulative"):
+    '''Returns the top functions of the merged profile as text.'''
+    stats = profile_stats()
+    if stats is None:
+        return "No profile recorded."
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats(sort).print_stats(limit)
+    return output.getvalue()
+
+
+metrics = Metrics()
+
+if os.environ.get(PROFILE_ENV):
+    enable_profiling(os.environ[PROFILE_ENV])
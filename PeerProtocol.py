@@ -0,0 +1,120 @@
+import base64
+import json
+import socket
+import struct
+
+
+# Every message between peers is a 4-byte big-endian length followed by that many bytes of JSON.
+# File data follows a reply header as raw bytes, exactly as many as the header announces.
+# Connections stay open after a reply, so a peer can send many requests, back to back, on one connection.
+HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1024 * 1024  # Largest JSON message accepted from a peer
+
+# Compact peer lists in tracker replies: 4-byte IPv4 address and 2-byte port per peer, base64-encoded.
+PEER_ENTRY = struct.Struct('!4sH')
+
+
+def is_framed(data):
+    '''Checks whether the first bytes received on a connection start a framed message.
+    Legacy clients send a bare filename, which never starts with a NUL byte.'''
+    return len(data) > 0 and data[0] == 0
+
+
+def encode_message(message):
+    '''Encodes a dict as a length-prefixed JSON frame.'''
+    payload = json.dumps(message).encode()
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_message(sock, message):
+    '''Sends a dict as one framed message.'''
+    sock.sendall(encode_message(message))
+
+
+def recv_exact(sock, size, initial=b"", limiter=None):
+    '''Receives exactly `size` bytes, starting with any bytes already read.
+    An optional rate limiter is charged for each chunk as it arrives.'''
+    buffer = bytearray(size)
+    buffer[:len(initial)] = initial
+    recv_into_exact(sock, memoryview(buffer)[len(initial):], limiter)
+    return bytes(buffer)
+
+
+def recv_into_exact(sock, view, limiter=None):
+    '''Fills a writable buffer (e.g. a memoryview of a reused bytearray) from the socket with recv_into,
+    so receiving allocates nothing. An optional rate limiter is charged for each chunk as it arrives.'''
+    filled = 0
+    while filled < len(view):
+        received = sock.recv_into(view[filled:])
+        if not received:
+            raise ConnectionError("Connection closed mid-message")
+        if limiter is not None:
+            limiter.consume(received)
+        filled += received
+    return view
+
+
+def recv_message(sock, initial=b""):
+    '''Receives one framed message and returns it as a dict.
+    `initial` holds bytes already read from the socket; it must not extend past the frame.'''
+    header = recv_exact(sock, HEADER.size, initial[:HEADER.size])
+    (size,) = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {size} bytes exceeds limit")
+    payload = recv_exact(sock, size, initial[HEADER.size:])
+    message = json.loads(payload.decode())
+    if not isinstance(message, dict):
+        raise ValueError("Message is not a JSON object")
+    return message
+
+
+def decode_message(data):
+    '''Decodes the framed message at the start of `data` without touching the socket it came from.
+    Returns None if the whole frame has not arrived yet.'''
+    if len(data) < HEADER.size:
+        return None
+    (size,) = HEADER.unpack_from(data)
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Message of {size} bytes exceeds limit")
+    if len(data) < HEADER.size + size:
+        return None
+    message = json.loads(bytes(data[HEADER.size:HEADER.size + size]).decode())
+    if not isinstance(message, dict):
+        raise ValueError("Message is not a JSON object")
+    return message
+
+
+def recv_next_message(sock):
+    '''Receives the next framed message on a keep-alive connection.
+    Returns None if the peer closed the connection cleanly between messages.'''
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+    return recv_message(sock, first)
+
+
+def pack_peers(peers):
+    '''Packs [(ip, port), ...] IPv4 peers into 6 bytes each, base64-encoded so they fit in JSON.'''
+    packed = b"".join(PEER_ENTRY.pack(socket.inet_aton(ip), port) for ip, port in peers)
+    return base64.b64encode(packed).decode()
+
+
+def unpack_peers(encoded):
+    '''Reverses pack_peers, returning [(ip, port), ...].'''
+    packed = base64.b64decode(encoded)
+    return [(socket.inet_ntoa(ip), port) for ip, port in PEER_ENTRY.iter_unpack(packed)]
+
+
+def pack_bitfield(indexes, count):
+    '''Packs a set of piece indexes out of `count` into a bitfield, piece 0 in the high bit of the first byte, base64-encoded.'''
+    bits = bytearray((count + 7) // 8)
+    for index in indexes:
+        if 0 <= index < count:
+            bits[index >> 3] |= 0x80 >> (index & 7)
+    return base64.b64encode(bits).decode()
+
+
+def unpack_bitfield(encoded, count):
+    '''Reverses pack_bitfield, returning the set of piece indexes.'''
+    bits = base64.b64decode(encoded)
+    return {index for index in range(min(count, len(bits) * 8)) if bits[index >> 3] & (0x80 >> (index & 7))}
@@ -0,0 +1,181 @@
+import os
+import sys
+import threading
+import time
+
+
+CONSOLE_INTERVAL = 0.2  # Minimum seconds between console progress redraws
+WINDOW_INTERVAL = 100  # Milliseconds between progress window refreshes
+BAR_WIDTH = 30  # Characters in the console progress bar
+
+
+def format_bytes(count):
+    '''Human-readable size, e.g. 12.3 MB.'''
+    if count < 1024:
+        return f"{count:.0f} B"
+    for unit in ("KB", "MB", "GB"):
+        count /= 1024
+        if count < 1024 or unit == "GB":
+            return f"{count:.1f} {unit}"
+
+
+def format_eta(seconds):
+    '''Human-readable time left, e.g. 1m05s.'''
+    if seconds is None:
+        return "--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class TransferProgress:
+    '''
+    Counts the bytes of one download as they actually arrive, overall and per peer.
+
+    Downloaders call update() from their worker threads; listeners are called
+    with the progress object after every update and decide for themselves
+    how often to redraw.
+    '''
+
+    def __init__(self, name="", total=0, listeners=()):
+        self.name = name
+        self.lock = threading.Lock()
+        self.listeners = list(listeners)
+        self.start(total)
+
+    def start(self, total, already=0):
+        '''(Re)start counting for a transfer of `total` bytes, `already` of which are on disk from an earlier attempt.'''
+        with self.lock:
+            self.total = total
+            self.already = already
+            self.received = 0
+            self.by_peer = {}  # { (ip, port): bytes received }
+            self.started = time.time()
+            self.finished = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def update(self, count, peer=None):
+        '''Record `count` bytes received, from `peer` if known.'''
+        with self.lock:
+            self.received += count
+            if peer is not None:
+                self.by_peer[peer] = self.by_peer.get(peer, 0) + count
+        for listener in self.listeners:
+            listener(self)
+
+    def finish(self):
+        '''Mark the transfer as over; listeners get a final call.'''
+        with self.lock:
+            self.finished = time.time()
+        for listener in self.listeners:
+            listener(self)
+
+    def snapshot(self):
+        '''Returns a dict with bytes done, total, fraction, rate (bytes/s), ETA (s) and per-peer rates.'''
+        with self.lock:
+            elapsed = max((self.finished or time.time()) - self.started, 1e-6)
+            done = self.already + self.received
+            rate = self.received / elapsed
+            left = max(self.total - done, 0)
+            return {
+                "name": self.name,
+                "done": done,
+                "total": self.total,
+                "fraction": done / self.total if self.total else 0.0,
+                "rate": rate,
+                "eta": left / rate if rate > 0 else None,
+                "elapsed": elapsed,
+                "finished": self.finished is not None,
+                "peers": {peer: count / elapsed for peer, count in self.by_peer.items()}
+            }
+
+
+def describe(snapshot):
+    '''One line summary of a snapshot: percentage, size, rate, ETA and number of peers.'''
+    line = (f"{snapshot['fraction'] * 100:5.1f}%  {format_bytes(snapshot['done'])}/{format_bytes(snapshot['total'])}"
+            f"  {format_bytes(snapshot['rate'])}/s  ETA {format_eta(snapshot['eta'])}")
+    if snapshot["peers"]:
+        line += f"  ({len(snapshot['peers'])} peer{'s' if len(snapshot['peers']) != 1 else ''})"
+    return line
+
+
+class ConsoleProgress:
+    '''Listener that redraws a one-line progress bar on a terminal, for headless use.'''
+
+    def __init__(self, stream=None, interval=CONSOLE_INTERVAL):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.last_drawn = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self, progress):
+        now = time.time()
+        snapshot = progress.snapshot()
+        with self.lock:
+            if not snapshot["finished"] and now - self.last_drawn < self.interval:
+                return
+            self.last_drawn = now
+            filled = int(snapshot["fraction"] * BAR_WIDTH)
+            bar = "#" * filled + "-" * (BAR_WIDTH - filled)
+            end = "\n" if snapshot["finished"] else ""
+            self.stream.write(f"\r[{bar}] {describe(snapshot)}{end}")
+            self.stream.flush()
+
+
+def gui_available():
+    '''True if tkinter is installed and there is a display to open a window on.'''
+    if os.name != "nt" and not os.environ.get("DISPLAY") and not os.environ.get("WAYLAND_DISPLAY"):
+        return False
+    try:
+        import tkinter  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def run_with_window(progress, target, *args):
+    '''
+    Runs target(*args) in a worker thread while a tkinter window shows the
+    live progress, and returns target's result once it finishes.
+
+    tkinter must own the main thread, so the transfer moves to a worker
+    instead. The window closes by itself when the transfer ends.
+    '''
+    import tkinter as tk
+    from tkinter import ttk
+
+    result = []
+    worker = threading.Thread(target=lambda: result.append(target(*args)), daemon=True)
+
+    root = tk.Tk()
+    root.title(f"Downloading {progress.name}" if progress.name else "Downloading...")
+    root.geometry("420x160")
+    label = tk.Label(root, text="Connecting to seeders...")
+    label.pack(pady=10)
+    progress_bar = ttk.Progressbar(root, mode='determinate', length=380, maximum=100)
+    progress_bar.pack(pady=5, fill=tk.X, padx=20)
+    peers_label = tk.Label(root, text="", justify=tk.LEFT)
+    peers_label.pack(pady=5)
+
+    def refresh():
+        snapshot = progress.snapshot()
+        if snapshot["total"]:
+            progress_bar["value"] = snapshot["fraction"] * 100
+            label["text"] = describe(snapshot)
+            peers_label["text"] = "\n".join(f"{ip}:{port}  {format_bytes(rate)}/s"
+                                            for (ip, port), rate in list(snapshot["peers"].items())[:4])
+        if worker.is_alive():
+            root.after(WINDOW_INTERVAL, refresh)
+        else:
+            root.destroy()
+
+    worker.start()
+    root.after(WINDOW_INTERVAL, refresh)
+    root.mainloop()
+    worker.join()
+    return result[0] if result else None
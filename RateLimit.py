@@ -0,0 +1,98 @@
+import threading
+import time
+import weakref
+
+
+class TokenBucket:
+    '''
+    Paces traffic to `rate` bytes per second, allowing bursts of up to `burst` bytes.
+
+    consume() takes the tokens up front and, if that leaves the bucket in
+    debt, sleeps until the debt is paid off, so a single call may ask for more
+    than the burst size. A rate of None means unlimited, and consume() then
+    returns without taking the lock.
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        '''Change the rate at runtime; None or 0 removes the limit. The burst defaults to a quarter second of traffic.'''
+        with self.lock:
+            self.rate = float(rate) if rate else None
+            self.burst = burst if burst is not None else (self.rate / 4 if self.rate else 0)
+            self.tokens = min(self.tokens, self.burst)
+            self.updated = time.monotonic()
+
+    def consume(self, amount):
+        '''Take `amount` tokens, sleeping as long as the rate requires.'''
+        if self.rate is None:
+            return
+        with self.lock:
+            rate = self.rate
+            if rate is None:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate) - amount
+            self.updated = now
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class RateLimits:
+    '''
+    A global limit shared by every connection plus a limit applied to each
+    connection separately, for one direction of traffic. Both can be changed
+    at any time, including for connections that are already open.
+    '''
+
+    def __init__(self, total=None, per_connection=None):
+        self.total = TokenBucket(total)
+        self.per_connection = per_connection or None
+        self.lock = threading.Lock()
+        self.limiters = weakref.WeakKeyDictionary()  # { socket: ConnectionLimiter }
+
+    def set(self, total=None, per_connection=None):
+        '''Set both limits in bytes per second; None removes a limit.'''
+        self.total.set_rate(total)
+        self.per_connection = per_connection or None
+
+    @property
+    def limited(self):
+        return self.total.rate is not None or self.per_connection is not None
+
+    def connection(self, sock):
+        '''Returns the limiter for a socket, shared by every transfer on that connection.'''
+        with self.lock:
+            limiter = self.limiters.get(sock)
+            if limiter is None:
+                limiter = self.limiters[sock] = ConnectionLimiter(self)
+            return limiter
+
+
+class ConnectionLimiter:
+    '''Charges traffic on one connection to its own bucket and to the global one.'''
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.bucket = TokenBucket(limits.per_connection)
+
+    @property
+    def limited(self):
+        return self.limits.limited
+
+    def consume(self, amount):
+        if self.bucket.rate != self.limits.per_connection:
+            self.bucket.set_rate(self.limits.per_connection)  # Limit changed at runtime
+        self.bucket.consume(amount)
+        self.limits.total.consume(amount)
+
+
+upload_limits = RateLimits()
+download_limits = RateLimits()
@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from HashUtils import build_manifests, stat_signature, HASH_WORKERS
+from Downloader import PARTIAL_SUFFIX, PROGRESS_SUFFIX
+
+
+SHARED_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.p2p_shared_index.sqlite')
+RESCAN_INTERVAL = 60  # Seconds between rescans of a shared directory
+SCAN_BATCH = 256  # New or changed files hashed, stored and announced together
+DOWNLOAD_SUFFIXES = (PARTIAL_SUFFIX, PROGRESS_SUFFIX, PROGRESS_SUFFIX + '.tmp')  # Files of downloads in progress
+
+
+class SharedDirectory:
+    '''
+    A directory tree shared under paths relative to its root, e.g. "sub/file.bin".
+
+    Every file's manifest is kept in a sqlite index next to the size, mtime
+    and inode it was hashed at. A scan walks the tree with os.scandir and only
+    rehashes files whose stat no longer matches, so rescans and restarts cost a
+    directory walk rather than a rehash. Unlike the hash cache the index has no
+    size limit, since a shared directory may hold tens of thousands of files.
+
+    scan(on_change) reports what it finds one batch at a time:
+    on_change(changed, removed) gets { name: (path, manifest) } for new and
+    modified files and a list of names that are gone.
+    '''
+
+    def __init__(self, directory, index_path=SHARED_INDEX_PATH, workers=HASH_WORKERS):
+        self.directory = directory
+        self.root = os.path.realpath(directory)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.scanned = threading.Event()  # Set once the first scan has finished
+        self.last_scan = None  # (hashed, removed, seconds) for the latest scan
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "root TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, manifest TEXT, "
+            "PRIMARY KEY (root, name))"
+        )
+        self.db.commit()
+        # Only the stat signatures stay in memory; manifests are read back when needed
+        self.signatures = {name: tuple(signature) for name, *signature in self.db.execute(
+            "SELECT name, size, mtime_ns, inode FROM files WHERE root = ?", (self.root,))}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.signatures)
+
+    def path(self, name):
+        '''Local path of a shared name.'''
+        return os.path.join(self.directory, *name.split('/'))
+
+    def entries(self):
+        '''Returns [(name, path, manifest), ...] for every indexed file, as of the last scan.'''
+        with self.lock:
+            rows = self.db.execute("SELECT name, manifest FROM files WHERE root = ?", (self.root,)).fetchall()
+        return [(name, self.path(name), json.loads(manifest)) for name, manifest in rows]
+
+    def walk(self):
+        '''Returns { name: (path, stat signature) } for every regular file in the tree.'''
+        found = {}
+        pending = [(self.directory, "")]
+        while pending:
+            directory, prefix = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.name.endswith(DOWNLOAD_SUFFIXES):
+                                continue  # Downloads in progress are shared by the download itself until complete
+                            if entry.is_file(follow_symlinks=False):
+                                found[prefix + entry.name] = (entry.path, stat_signature(entry.stat(follow_symlinks=False)))
+                            elif entry.is_dir(follow_symlinks=False):
+                                pending.append((entry.path, prefix + entry.name + "/"))
+                        except OSError:
+                            continue  # Removed while we were looking at it
+            except OSError:
+                continue  # Directory removed or unreadable
+        return found
+
+    def scan(self, on_change=None):
+        '''Brings the index in step with the files on disk. Returns (files hashed, files removed).'''
+        started = time.time()
+        found = self.walk()
+        with self.lock:
+            removed = [name for name in self.signatures if name not in found]
+            changed = [name for name, (_, signature) in found.items() if self.signatures.get(name) != signature]
+            if removed:
+                self.db.executemany("DELETE FROM files WHERE root = ? AND name = ?", [(self.root, name) for name in removed])
+                self.db.commit()
+                for name in removed:
+                    del self.signatures[name]
+        if removed and on_change:
+            on_change({}, removed)
+
+        hashed = 0
+        for start in range(0, len(changed), SCAN_BATCH):
+            batch = changed[start:start + SCAN_BATCH]
+            manifests = build_manifests([found[name][0] for name in batch], use_cache=False, workers=self.workers)
+            updates, rows = {}, []
+            for name in batch:
+                path, signature = found[name]
+                if path not in manifests:
+                    continue  # Vanished or unreadable; the next scan tries again
+                updates[name] = (path, manifests[path])
+                rows.append((self.root, name, *signature, json.dumps(manifests[path])))
+            with self.lock:
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.db.commit()
+                for name in updates:
+                    self.signatures[name] = found[name][1]
+            hashed += len(updates)
+            if updates and on_change:
+                on_change(updates, [])
+
+        self.last_scan = (hashed, len(removed), time.time() - started)
+        self.scanned.set()
+        return hashed, len(removed)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
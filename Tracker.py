@@ -1,134 +1,585 @@
+import argparse
+import asyncio
+import collections
+import heapq
+import json
+import logging
+import os
+import random
 import socket
 import threading
-import json
 import time
+from PeerProtocol import pack_peers
+from Metrics import metrics, profiled, enable_profiling, format_metrics
 
 TRACKER_HOST = '0.0.0.0'
 TRACKER_PORT = 5000
 PEER_TIMEOUT = 30
-peers = {}  # { "filename": [ (PEER_IP, PEER_PORT, file_hash)] }
-peer_heartbeat = {}  # { (peer_ip, peer_port): last_heartbeat_time }
-file_hashes = {}  # { "filename": { (peer_ip, peer_port): hash_value } }
+MAX_DATAGRAM_SIZE = 65507  # Largest UDP payload; REGISTER carries a full manifest
+COMPACT_REPLY_SIZE = 1400  # Compact REQUEST replies carry manifests only while they fit in one unfragmented packet
+BATCH_SIZE = 256  # Datagrams processed before yielding back to the event loop
+MAX_QUEUED_DATAGRAMS = 50000  # Datagrams beyond this are dropped during bursts; clients retry
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024  # Kernel socket buffer that absorbs bursts
+DEFAULT_PEER_LIMIT = 50  # Seeders returned per REQUEST unless the client asks for another limit
+MAX_PEER_LIMIT = 5000  # Upper bound on the limit a client may ask for
+MAX_NAME_SIZE = 4096  # Longest filename or hash accepted, in UTF-8 bytes; longer ones could never fit in a reply
+STATE_PATH = 'tracker_state.json'  # Registry snapshot reloaded at startup
+SNAPSHOT_INTERVAL = 10  # Seconds between snapshots, taken only if the registry changed
+ACTIONS = {"REGISTER", "ANNOUNCE", "SCRAPE", "REQUEST", "REQUEST_BY_HASH", "MANIFEST", "HEARTBEAT", "EXIT", "METRICS", "STATS"}
+TRACKER_ID = os.urandom(8).hex()  # Changes on every start, so peers notice a restart in the next heartbeat ack
+log = logging.getLogger("tracker")
+
+class TrackerRegistry:
+    '''All tracker state, indexed by filename, by content hash and by peer, guarded by a single lock.
+
+    Removing a peer only touches the files it seeds (via the peer -> files index),
+    and expiry uses a heap of heartbeat deadlines, so churn costs O(files per peer + log n)
+    instead of a scan over every file. The content hash index pools every copy of the
+    same bytes into one swarm, whatever name each seeder shares it under.'''
+
+    def __init__(self, peer_timeout=PEER_TIMEOUT):
+        self.peer_timeout = peer_timeout
+        self.lock = threading.Lock()
+        self.files = {}  # { "filename": { (peer_ip, peer_port): file_hash } }
+        self.peer_files = {}  # { (peer_ip, peer_port): { "filename", ... } }
+        self.heartbeats = {}  # { (peer_ip, peer_port): last_heartbeat_time }
+        self.hashes = {}  # { file_hash: { (peer_ip, peer_port): { "filename", ... } } }
+        self.manifests = {}  # { file_hash: manifest }, kept while any seeder advertises the hash
+        self.expiry = []  # Heap of (deadline, (peer_ip, peer_port)); stale entries are skipped when popped
+        self.version = 0  # Bumped on every change to which peers seed what, so unchanged state is not snapshotted again
+
+    def _touch(self, peer, now):
+        self.heartbeats[peer] = now
+        heapq.heappush(self.expiry, (now + self.peer_timeout, peer))
+
+    def _index_hash(self, peer, filename, file_hash):
+        if file_hash is None:
+            return  # Registrations without a hash cannot join a content swarm
+        self.hashes.setdefault(file_hash, {}).setdefault(peer, set()).add(filename)
+
+    def _release_hash(self, peer, filename, file_hash):
+        holders = self.hashes.get(file_hash)
+        if holders is None or peer not in holders:
+            return
+        holders[peer].discard(filename)
+        if not holders[peer]:
+            del holders[peer]
+        if not holders:
+            del self.hashes[file_hash]
+            self.manifests.pop(file_hash, None)
+
+    def _clear_files(self, peer):
+        self.version += 1
+        for filename in self.peer_files.pop(peer, ()):
+            seeders = self.files.get(filename)
+            if seeders is None or peer not in seeders:
+                continue
+            self._release_hash(peer, filename, seeders.pop(peer))
+            if not seeders:
+                del self.files[filename]
+
+    def _remove(self, peer):
+        self._clear_files(peer)
+        return self.heartbeats.pop(peer, None) is not None
+
+    def register(self, peer, filename, file_hash, manifest=None):
+        '''Records a peer as a seeder of a file; returns True if it was not seeding it before.'''
+        with self.lock:
+            seeders = self.files.setdefault(filename, {})
+            is_new = peer not in seeders
+            if is_new or seeders[peer] != file_hash:
+                self.version += 1
+                if not is_new:
+                    self._release_hash(peer, filename, seeders[peer])
+                seeders[peer] = file_hash
+                self._index_hash(peer, filename, file_hash)
+            self.peer_files.setdefault(peer, set()).add(filename)
+            # Keep the manifest so downloaders can verify piece by piece. The first one stays: a later
+            # registrant cannot swap in its own pieces for a hash others already seed
+            if manifest and manifest.get("hash") == file_hash and file_hash not in self.manifests:
+                self.manifests[file_hash] = manifest
+            if is_new:
+                # Registration counts as the initial heartbeat
+                self._touch(peer, time.time())
+            return is_new
+
+    def unregister(self, peer, filename):
+        '''Stops listing a peer as a seeder of one file; returns True if it was seeding it.'''
+        with self.lock:
+            seeders = self.files.get(filename)
+            if seeders is None or peer not in seeders:
+                return False
+            self._release_hash(peer, filename, seeders.pop(peer))
+            if not seeders:
+                del self.files[filename]
+            self.peer_files.get(peer, set()).discard(filename)
+            self.version += 1
+            return True
+
+    def clear_files(self, peer):
+        '''Forgets every file a peer seeds but keeps the peer, before it announces its full list again.'''
+        with self.lock:
+            self._clear_files(peer)
+
+    def heartbeat(self, peer):
+        '''Records that a peer is alive; returns False for a peer the tracker does not know,
+        which should announce its files again.'''
+        with self.lock:
+            if peer not in self.heartbeats:
+                return False
+            self._touch(peer, time.time())
+            return True
+
+    def remove_peer(self, peer):
+        '''Forgets a peer and every file it seeds; returns True if the peer was known.'''
+        with self.lock:
+            return self._remove(peer)
+
+    def expire(self, now=None):
+        '''Removes peers whose last heartbeat is older than the timeout and returns them.'''
+        now = time.time() if now is None else now
+        expired = []
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                _, peer = heapq.heappop(self.expiry)
+                last_heartbeat = self.heartbeats.get(peer)
+                # Skip entries superseded by a later heartbeat or for peers already removed
+                if last_heartbeat is not None and last_heartbeat + self.peer_timeout <= now:
+                    self._remove(peer)
+                    expired.append(peer)
+        return expired
+
+    def get_seeders(self, filename):
+        '''Returns [(peer_ip, peer_port, file_hash, filename), ...] for a file.'''
+        with self.lock:
+            return [(ip, port, file_hash, filename) for (ip, port), file_hash in self.files.get(filename, {}).items()]
 
-def handlePeer(sock, addr):
+    def get_seeders_by_hash(self, file_hash):
+        '''Returns [(peer_ip, peer_port, file_hash, filename), ...] for every seeder of the given content,
+        with the name that seeder shares it under.'''
+        with self.lock:
+            return [(ip, port, file_hash, min(filenames)) for (ip, port), filenames in self.hashes.get(file_hash, {}).items()]
+
+    def scrape(self, filenames):
+        '''Returns { filename: number of seeders } for the given files.'''
+        with self.lock:
+            return {filename: len(self.files.get(filename, ())) for filename in filenames}
+
+    def get_manifests(self, file_hashes):
+        '''Returns { file_hash: manifest } for the given hashes that have a manifest.'''
+        with self.lock:
+            return {h: self.manifests[h] for h in file_hashes if h in self.manifests}
+
+    def sizes(self):
+        '''Returns the number of live peers, filenames and distinct content hashes.'''
+        with self.lock:
+            return {"peers": len(self.heartbeats), "files": len(self.files), "hashes": len(self.hashes)}
+
+    def snapshot(self):
+        '''Returns (version, state) with a JSON-serialisable copy of every registration.'''
+        with self.lock:
+            files = {filename: [[ip, port, file_hash] for (ip, port), file_hash in seeders.items()]
+                     for filename, seeders in self.files.items()}
+            return self.version, {"files": files, "manifests": dict(self.manifests)}
+
+    def restore(self, state):
+        '''Loads registrations from a snapshot. Every restored peer gets a full timeout to send its
+        next heartbeat, so live seeders carry on and the ones that left meanwhile expire.'''
+        now = time.time()
+        with self.lock:
+            for filename, seeders in state.get("files", {}).items():
+                for ip, port, file_hash in seeders:
+                    peer = (ip, port)
+                    self.files.setdefault(filename, {})[peer] = file_hash
+                    self._index_hash(peer, filename, file_hash)
+                    self.peer_files.setdefault(peer, set()).add(filename)
+                    if peer not in self.heartbeats:
+                        self._touch(peer, now)
+            self.manifests.update({h: manifest for h, manifest in state.get("manifests", {}).items() if h in self.hashes})
+            return len(self.heartbeats)
+
+registry = TrackerRegistry()
+
+def validName(value):
+    '''True for a filename or hash the tracker accepts: a string of at most MAX_NAME_SIZE bytes.'''
+    return isinstance(value, str) and len(value.encode(errors="replace")) <= MAX_NAME_SIZE
+
+def validPort(value):
+    '''True for a TCP port a seeder can listen on; anything else would break every compact reply listing it.'''
+    return isinstance(value, int) and not isinstance(value, bool) and 0 < value < 65536
+
+def validEntry(filename, file_hash, manifest):
+    '''True if a registration's filename, hash and manifest have the types the registry indexes them by.'''
+    return validName(filename) and validName(file_hash) and (manifest is None or isinstance(manifest, dict))
+
+def pageArguments(message):
+    '''Returns the (limit, offset) a REQUEST asks for, clamped to what the tracker allows. Raises ValueError if either is not a number.'''
+    try:
+        limit = max(1, min(int(message.get("limit") or DEFAULT_PEER_LIMIT), MAX_PEER_LIMIT))
+        offset = message.get("offset")
+        return limit, None if offset is None else max(0, int(offset))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Invalid limit or offset")
+
+def selectSeeders(seeders, limit, offset=None):
+    '''Picks the seeders to return: a page starting at `offset` if given, otherwise a random sample.
+    Random samples spread downloaders across a large swarm instead of sending everyone to the same seeders.'''
+    if offset is not None:
+        return sorted(seeders)[offset:offset + limit]
+    if len(seeders) > limit:
+        return random.sample(seeders, limit)
+    return seeders
+
+def groupSeeders(selected):
+    '''Groups (ip, port, file_hash, filename) seeders into { (file_hash, filename): [(ip, port), ...] }.'''
+    swarms = {}
+    for ip, port, file_hash, filename in selected:
+        swarms.setdefault((file_hash, filename), []).append((ip, port))
+    return swarms
+
+def encodePeerReply(filename, selected, total, manifests, compact):
+    '''Encodes a REQUEST or REQUEST_BY_HASH reply that fits in one datagram.
+    Compact replies group seeders by hash and filename (so each is sent once) and pack each seeder into 6 bytes.
+    Manifests that do not fit are left out and flagged; clients fetch them with MANIFEST. Compact replies
+    keep manifests only while the reply fits in one packet, since losing any IP fragment loses the whole reply.'''
+    swarms = groupSeeders(selected)
+    swarm_sizes = {}
+    for (file_hash, _), members in swarms.items():
+        swarm_sizes[file_hash] = swarm_sizes.get(file_hash, 0) + len(members)
+    # Keep the manifests of the biggest swarms if not all of them fit
+    manifests = dict(sorted(manifests.items(), key=lambda item: swarm_sizes.get(item[0], 0), reverse=True))
+    omitted = False
+    size_limit = COMPACT_REPLY_SIZE if compact else MAX_DATAGRAM_SIZE
     while True:
+        if compact:
+            reply = {
+                "filename": filename,
+                "total": total,
+                "swarms": [{"hash": h, "filename": name, "peers": pack_peers(members)} for (h, name), members in swarms.items()],
+                "manifests": manifests
+            }
+        else:
+            reply = {
+                "peers": [{"ip": ip, "port": port, "hash": file_hash, "filename": name} for ip, port, file_hash, name in selected],
+                "manifests": manifests,
+                "total": total
+            }
+        if omitted:
+            reply["manifests_omitted"] = True
+        response = json.dumps(reply).encode()
+        if len(response) <= MAX_DATAGRAM_SIZE and (not manifests or len(response) <= size_limit):
+            return response
+        if manifests:
+            manifests.popitem()
+            omitted = True
+        elif not selected:
+            # Not even an empty peer list fits, so nothing will
+            return json.dumps({"error": "Reply too large", "total": total}).encode()
+        else:
+            # Even the bare peer list is too large: halve it, the client can page with `offset`
+            selected = selected[:len(selected) // 2]
+            swarms = groupSeeders(selected)
+
+@profiled
+def handlePeer(message, peer_addr):
+    '''Applies one tracker message and returns the encoded reply, or None if the action has no reply.'''
+    action = message.get("action")
+    
+    if action == "REGISTER":
+        '''Register seeder to tracker with file hash.'''
+        filename = message.get("filename")
+        file_hash = message.get("file_hash")
+        manifest = message.get("manifest")
+        peer_ip = peer_addr[0]
+        peer_port = message.get("port", peer_addr[1])
+        if not validPort(peer_port) or not validEntry(filename, file_hash, manifest):
+            log.debug(f"Dropped invalid REGISTER from {peer_addr}")
+            return None
+        
+        if registry.register((peer_ip, peer_port), filename, file_hash, manifest):
+            log.info(f"Registered {peer_ip}:{peer_port} for {filename}")
+            log.info(f"  File Hash (SHA256): {(file_hash or '')[:16]}...")
+
+    elif action == "ANNOUNCE":
+        '''Registers (and unregisters) many files for one seeder at once and acknowledges the batch.'''
+        peer_ip = peer_addr[0]
+        peer_port = message.get("port", peer_addr[1])
+        files = message.get("files", [])
+        removed = message.get("removed", [])
+        if not validPort(peer_port) or not isinstance(files, list) or not isinstance(removed, list):
+            log.debug(f"Dropped invalid ANNOUNCE from {peer_addr}")
+            return None
+        # Entries with a bad filename, hash or manifest are skipped, not acknowledged
+        files = [entry for entry in files if isinstance(entry, dict)
+                 and validEntry(entry.get("filename"), entry.get("file_hash"), entry.get("manifest"))]
+        removed = [filename for filename in removed if validName(filename)]
+        if message.get("replace"):
+            # A full re-announce: drop whatever an old snapshot still lists for this peer
+            registry.clear_files((peer_ip, peer_port))
+        new_files = 0
+        for entry in files:
+            if registry.register((peer_ip, peer_port), entry.get("filename"), entry.get("file_hash"), entry.get("manifest")):
+                new_files += 1
+        # Files the seeder no longer shares, e.g. deleted from a shared directory
+        removed_files = sum(registry.unregister((peer_ip, peer_port), filename) for filename in removed)
+        if new_files:
+            log.info(f"Registered {peer_ip}:{peer_port} for {new_files} new file(s) ({len(files)} announced)")
+        if removed_files:
+            log.info(f"Unregistered {peer_ip}:{peer_port} for {removed_files} removed file(s)")
+        return json.dumps({"action": "ACK", "seq": message.get("seq"), "tracker": TRACKER_ID,
+                           "registered": len(files), "removed": len(removed)}).encode()
+
+    elif action == "SCRAPE":
+        '''Sends out seeder counts for many files at once.'''
+        filenames = message.get("filenames", [])
+        if not isinstance(filenames, list):
+            return json.dumps({"error": "Invalid filenames"}).encode()
+        counts = registry.scrape([filename for filename in filenames if validName(filename)])
+        # Answer as many as fit in one datagram; the client asks again for the rest
+        files, size = {}, len('{"files": {}}')
+        for filename, count in counts.items():
+            size += len(json.dumps(filename)) + len(str(count)) + 4
+            if size > MAX_DATAGRAM_SIZE:
+                break
+            files[filename] = count
+        return json.dumps({"files": files}).encode()
+
+    elif action == "REQUEST":
+        '''Sends out a list of active seeders with their hashes and manifests on request from the peers'''
+        filename = message.get("filename")
+        if not validName(filename):
+            return json.dumps({"error": "Invalid filename"}).encode()
         try:
-            data, peer_addr = sock.recvfrom(1024)
-            message = json.loads(data.decode())
-            action = message.get("action")
-            
-            if action == "REGISTER":
-                '''Register seeder to tracker with file hash.'''
-                filename = message.get("filename")
-                file_hash = message.get("file_hash")
-                peer_ip = peer_addr[0]
-                peer_port = message.get("port", peer_addr[1])
-                
-                if filename not in peers:
-                    peers[filename] = []
-                    file_hashes[filename] = {}
-                
-                # Check if peer is already seeding this file
-                peer_exists = any((ip, port) == (peer_ip, peer_port) for ip, port, _ in peers[filename])
-                
-                if not peer_exists:
-                    peers[filename].append((peer_ip, peer_port, file_hash))
-                    file_hashes[filename][(peer_ip, peer_port)] = file_hash
-                    # Track when this peer registered (use as initial heartbeat)
-                    peer_heartbeat[(peer_ip, peer_port)] = time.time()
-                    print('\033[32m'+f"Registered {peer_ip}:{peer_port} for {filename}"+'\033[0m')
-                    print('\033[32m'+f"  File Hash (SHA256): {file_hash[:16]}..."+'\033[0m')
-                else:
-                    # Update hash if already registered
-                    peers[filename] = [(ip, port, file_hash) if (ip, port) == (peer_ip, peer_port) else (ip, port, h) for ip, port, h in peers[filename]]
-                    file_hashes[filename][(peer_ip, peer_port)] = file_hash
-
-            elif action == "REQUEST":
-                '''Sends out a list of active seeders with their hashes on request from the peers'''
-                filename = message.get("filename")
-                available_peers = peers.get(filename, [])
-                # Return peers as list of dicts with peer info and hash
-                peer_list = [{"ip": ip, "port": port, "hash": file_hash} for ip, port, file_hash in available_peers]
-                response = json.dumps(peer_list).encode()
-                sock.sendto(response, peer_addr)
-                print('\033[32m'+f"Sent peer list for {filename} to {peer_addr}"+'\033[0m')
-            
-            elif action == "HEARTBEAT":
-                '''Periodically sends out alerts of heartbeat meassages.'''
-                peer_ip = peer_addr[0]
-                peer_port = message.get("port")
-                peer_heartbeat[(peer_ip, peer_port)] = time.time()
-                print('\033[32m'+f"Received heartbeat from peer {peer_ip}:{peer_port}"+'\033[0m')
-
-            elif action == "EXIT":
-                '''Removes the peer from the list, print a disconnected message.'''
-                peer_ip = peer_addr[0]
-                peer_port = message.get("port")
-                for filename in list(peers.keys()):
-                    peers[filename] = [(ip, port, h) for ip, port, h in peers[filename] if (ip, port) != (peer_ip, peer_port)]
-                    if not peers[filename]:  
-                        del peers[filename]
-                        if filename in file_hashes:
-                            del file_hashes[filename]
-                    else:
-                        # Remove from file hashes dict
-                        if filename in file_hashes and (peer_ip, peer_port) in file_hashes[filename]:
-                            del file_hashes[filename][(peer_ip, peer_port)]
-                
-                if (peer_ip, peer_port) in peer_heartbeat:
-                    del peer_heartbeat[(peer_ip, peer_port)]
-
-                print('\033[31m'+f"Peer {peer_ip}:{peer_port} disconnected."+'\033[0m')
+            limit, offset = pageArguments(message)
+        except ValueError as e:
+            return json.dumps({"error": str(e)}).encode()
+        available_peers = registry.get_seeders(filename)
+        selected = selectSeeders(available_peers, limit, offset)
+        # Return the selected peers with their hashes, plus one manifest per distinct hash
+        peer_manifests = registry.get_manifests({h for _, _, h, _ in selected})
+        log.debug(f"Sent peer list for {filename} to {peer_addr}")
+        return encodePeerReply(filename, selected, len(available_peers), peer_manifests, bool(message.get("compact")))
 
-        except Exception as e:
-            print('\033[31m'+f"Error handling peer: {e}"+'\033[0m')
+    elif action == "REQUEST_BY_HASH":
+        '''Sends out every seeder of a piece of content, under whatever name each one shares it.'''
+        file_hash = message.get("file_hash")
+        if not validName(file_hash):
+            return json.dumps({"error": "Invalid file hash"}).encode()
+        try:
+            limit, offset = pageArguments(message)
+        except ValueError as e:
+            return json.dumps({"error": str(e)}).encode()
+        available_peers = registry.get_seeders_by_hash(file_hash)
+        selected = selectSeeders(available_peers, limit, offset)
+        log.debug(f"Sent peer list for hash {str(file_hash)[:16]}... to {peer_addr}")
+        return encodePeerReply(None, selected, len(available_peers), registry.get_manifests([file_hash]), bool(message.get("compact")))
+
+    elif action == "MANIFEST":
+        '''Sends the manifest for one content hash, for replies that had to leave it out.'''
+        file_hash = message.get("file_hash")
+        return json.dumps({"file_hash": file_hash, "manifest": registry.get_manifests([file_hash]).get(file_hash)}).encode()
+    
+    elif action == "HEARTBEAT":
+        '''Periodically sends out alerts of heartbeat meassages.'''
+        peer_ip = peer_addr[0]
+        peer_port = message.get("port")
+        known = registry.heartbeat((peer_ip, peer_port))
+        log.debug(f"Received heartbeat from peer {peer_ip}:{peer_port}")
+        if "seq" in message:
+            # Peers that ask for an ack re-announce if the tracker restarted or has forgotten them
+            return json.dumps({"action": "ACK", "seq": message["seq"], "tracker": TRACKER_ID, "known": known}).encode()
 
-def check_peer_timeout():
+    elif action in ("METRICS", "STATS"):
+        '''Sends request counts and latencies, traffic and registry sizes.'''
+        snapshot = metrics.snapshot()
+        snapshot["gauges"].update({f"tracker.{name}": count for name, count in registry.sizes().items()})
+        return json.dumps(dict(snapshot, tracker=TRACKER_ID)).encode()
+
+    elif action == "EXIT":
+        '''Removes the peer from the list, print a disconnected message.'''
+        peer_ip = peer_addr[0]
+        peer_port = message.get("port")
+        registry.remove_peer((peer_ip, peer_port))
+        log.info(f"Peer {peer_ip}:{peer_port} disconnected.")
+
+    return None
+
+async def check_peer_timeout():
     '''Periodically check for inactive peers and remove them.'''
     while True:
         try:
-            time.sleep(5)  # Check every 5 seconds
-            current_time = time.time()
-            inactive_peers = []
-            
-            # Find inactive peers
-            for (peer_ip, peer_port), last_heartbeat in list(peer_heartbeat.items()):
-                if current_time - last_heartbeat > PEER_TIMEOUT:
-                    inactive_peers.append((peer_ip, peer_port))
-            
-            # Remove inactive peers from tracking
-            for peer_ip, peer_port in inactive_peers:
-                # Remove from all file lists
-                for filename in list(peers.keys()):
-                    peers[filename] = [(ip, port, h) for ip, port, h in peers[filename] 
-                                      if (ip, port) != (peer_ip, peer_port)]
-                    if not peers[filename]:
-                        del peers[filename]
-                        if filename in file_hashes:
-                            del file_hashes[filename]
-                    else:
-                        # Remove from file hashes dict
-                        if filename in file_hashes and (peer_ip, peer_port) in file_hashes[filename]:
-                            del file_hashes[filename][(peer_ip, peer_port)]
-                
-                # Remove from heartbeat tracking
-                if (peer_ip, peer_port) in peer_heartbeat:
-                    del peer_heartbeat[(peer_ip, peer_port)]
-                
-                print('\033[31m'+f"Peer {peer_ip}:{peer_port} timed out and was removed."+'\033[0m')
+            await asyncio.sleep(5)  # Check every 5 seconds
+            for peer_ip, peer_port in registry.expire():
+                log.info(f"Peer {peer_ip}:{peer_port} timed out and was removed.")
         
         except Exception as e:
-            print('\033[31m'+f"Error in timeout check: {e}"+'\033[0m')
+            log.error(f"Error in timeout check: {e}")
 
-def start_tracker():
-    '''Start the tracker main thread'''
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((TRACKER_HOST, TRACKER_PORT))
-    print('\033[33m'+f"Tracker started on {TRACKER_HOST}:{TRACKER_PORT}"+'\033[0m')
-    
+class TrackerProtocol(asyncio.DatagramProtocol):
+    '''Queues incoming datagrams and processes them in batches.
+    When the queue is full new datagrams are dropped (UDP clients retry), and replies wait while the socket's send buffer is full.'''
+
+    def __init__(self):
+        self.transport = None
+        self.queue = collections.deque()
+        self.ready = asyncio.Event()
+        self.can_send = asyncio.Event()
+        self.can_send.set()
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(self.queue) >= MAX_QUEUED_DATAGRAMS:
+            self.dropped += 1
+            metrics.incr("tracker.dropped")
+            return
+        self.queue.append((data, addr))
+        self.ready.set()
+
+    def error_received(self, exc):
+        log.debug(f"Socket error: {exc}")
+
+    def pause_writing(self):
+        self.can_send.clear()
+
+    def resume_writing(self):
+        self.can_send.set()
+
+    def processDatagram(self, data, addr):
+        '''Decodes and applies one datagram, sending its reply if it has one.
+        Counts requests and bytes and records how long each action takes.'''
+        start = time.perf_counter()
+        action = "invalid"
+        try:
+            message = json.loads(data.decode())
+            action = message.get("action") if message.get("action") in ACTIONS else "unknown"
+            response = handlePeer(message, addr)
+            if response is not None:
+                self.transport.sendto(response, addr)
+                metrics.incr("tracker.bytes_out", len(response))
+        except Exception as e:
+            metrics.incr("tracker.errors")
+            log.error(f"Error handling peer {addr}: {e}")
+        metrics.incr("tracker.bytes_in", len(data))
+        metrics.incr(f"tracker.requests.{action}")
+        metrics.observe(f"tracker.latency.{action}", time.perf_counter() - start)
+
+    async def process(self):
+        '''Drains the queue in batches, yielding to the event loop between batches so reads keep up.'''
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                metrics.set_gauge("tracker.queued", len(self.queue))
+                await self.can_send.wait()
+                for _ in range(min(BATCH_SIZE, len(self.queue))):
+                    self.processDatagram(*self.queue.popleft())
+                await asyncio.sleep(0)
+            if self.dropped:
+                log.warning(f"Tracker overloaded: dropped {self.dropped} datagrams.")
+                self.dropped = 0
+
+def loadState(path):
+    '''Reloads the registry from the last snapshot, if there is one.'''
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        log.warning(f"Ignoring unreadable tracker state {path}: {e}")
+        return
+    peers = registry.restore(state)
+    age = time.time() - state.get("saved", time.time())
+    log.info(f"Restored {len(state.get('files', {}))} file(s) from {peers} peer(s) ({age:.0f}s old snapshot)")
+
+def saveState(path, state):
+    '''Writes a snapshot atomically, so a crash mid-write leaves the previous one intact.'''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(state, saved=time.time()), f)
+    os.replace(path + '.tmp', path)
+
+async def snapshot_state(path):
+    '''Periodically snapshots the registry while it keeps changing. Serialising runs off the event loop.'''
+    saved_version = registry.snapshot()[0]
+    try:
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            if registry.version != saved_version:
+                version, state = registry.snapshot()
+                try:
+                    await asyncio.to_thread(saveState, path, state)
+                    saved_version = version
+                except OSError as e:
+                    log.error(f"Error saving tracker state: {e}")
+    finally:
+        if registry.version != saved_version:
+            saveState(path, registry.snapshot()[1])  # Shutting down: save the latest changes too
+
+async def log_metrics(interval):
+    '''Logs the metrics every `interval` seconds.'''
     while True:
-        handlePeer(sock, TRACKER_HOST)
+        await asyncio.sleep(interval)
+        snapshot = metrics.snapshot()
+        snapshot["gauges"].update({f"tracker.{name}": count for name, count in registry.sizes().items()})
+        log.info(format_metrics(snapshot))
 
-if __name__ == "__main__":
-    start_tracker()
+class ColorFormatter(logging.Formatter):
+    '''Colors log lines by level, matching the colored output of the clients.'''
+    COLORS = {logging.DEBUG: '\033[32m', logging.INFO: '\033[32m', logging.WARNING: '\033[33m', logging.ERROR: '\033[31m'}
 
+    def format(self, record):
+        return self.COLORS.get(record.levelno, '') + super().format(record) + '\033[0m'
+
+async def serve_tracker(host=None, port=None, state_path=STATE_PATH, metrics_interval=0):
+    '''Run the tracker on the current event loop. With a state path, the registry is reloaded
+    from it at startup and snapshotted to it while running. With a metrics interval, metrics are logged that often.'''
+    host = host or TRACKER_HOST
+    port = port or TRACKER_PORT
+    if state_path:
+        loadState(state_path)
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(TrackerProtocol, local_addr=(host, port))
+    try:
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+    except OSError:
+        pass  # Keep the default buffer if the OS refuses a larger one
+    log.info(f"Tracker started on {host}:{port}")
+    tasks = [protocol.process(), check_peer_timeout()]
+    if state_path:
+        tasks.append(snapshot_state(state_path))
+    if metrics_interval:
+        tasks.append(log_metrics(metrics_interval))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        transport.close()
+
+def start_tracker(log_level=logging.INFO, port=None, state_path=STATE_PATH, metrics_interval=0):
+    '''Start the tracker and block until it stops.'''
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(ColorFormatter("%(message)s"))
+        log.addHandler(handler)
+    log.setLevel(log_level)
+    try:
+        asyncio.run(serve_tracker(port=port, state_path=state_path, metrics_interval=metrics_interval))
+    except KeyboardInterrupt:
+        log.info("Tracker stopped.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tracker for the P2P file sharing system.")
+    parser.add_argument("--port", type=int, default=TRACKER_PORT, help="UDP port to listen on")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs every heartbeat and peer list request")
+    parser.add_argument("--state", default=STATE_PATH,
+                        help="file the registry is snapshotted to and reloaded from; empty to keep it in memory only (default: %(default)s)")
+    parser.add_argument("--metrics-interval", type=float, default=0, metavar="SECONDS",
+                        help="log request rates, latencies and registry sizes this often (default: never)")
+    parser.add_argument("--profile", metavar="PATH", help="profile request handling and write pstats to PATH on exit")
+    args = parser.parse_args()
+    if args.profile:
+        enable_profiling(args.profile)
+    start_tracker(getattr(logging, args.log_level), args.port, args.state, args.metrics_interval)
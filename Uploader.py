@@ -0,0 +1,217 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+from PeerProtocol import decode_message, is_framed, send_message
+
+
+UPLOAD_WORKERS = 8  # Requests served at once, across all peers
+UPLOAD_SLOTS_PER_PEER = 2  # Requests from one peer address served at once
+MAX_CONNECTIONS = 256  # Open peer connections, idle or busy
+MAX_CONNECTIONS_PER_PEER = 16  # Open connections from one peer address
+MAX_QUEUED_REQUESTS = 128  # Requests waiting for a worker before new ones are turned away as busy
+IDLE_TIMEOUT = 30  # Seconds an idle connection is kept open for further requests
+REQUEST_TIMEOUT = 10  # Seconds a worker waits on a stalled peer while reading a request or sending a reply
+REJECT_PEEK_SIZE = 4096  # Bytes of a turned-away request looked at for its id
+
+
+class UploadScheduler:
+    '''
+    Serves peer requests from a fixed pool of worker threads.
+
+    Idle keep-alive connections wait in a selector rather than holding a
+    thread each. When one has a request, it joins a per-peer queue, and workers
+    take peers in round-robin order. No peer address gets more than
+    UPLOAD_SLOTS_PER_PEER workers at once, so one aggressive downloader cannot
+    choke everybody else. Once MAX_QUEUED_REQUESTS requests are waiting, new
+    requests get a "busy" reply so the downloader asks another seeder.
+
+    `serve(conn, addr)` handles one request and returns True to keep the
+    connection open for the next one.
+    '''
+
+    def __init__(self, serve, workers=UPLOAD_WORKERS, slots_per_peer=UPLOAD_SLOTS_PER_PEER,
+                 max_connections=MAX_CONNECTIONS, max_connections_per_peer=MAX_CONNECTIONS_PER_PEER,
+                 max_queued=MAX_QUEUED_REQUESTS, idle_timeout=IDLE_TIMEOUT):
+        self.serve = serve
+        self.workers = workers
+        self.slots_per_peer = slots_per_peer
+        self.max_connections = max_connections
+        self.max_connections_per_peer = max_connections_per_peer
+        self.max_queued = max_queued
+        self.idle_timeout = idle_timeout
+        self.running = False
+        self.condition = threading.Condition()
+        self.selector = selectors.DefaultSelector()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+        self.connections = {}  # { conn: addr } for every open connection
+        self.connections_from = collections.Counter()  # { peer_ip: open connections }
+        self.idle_since = {}  # { conn: time } for connections waiting in the selector
+        self.returning = []  # Connections handed back by workers, registered by the selector thread
+        self.waiting = collections.OrderedDict()  # { peer_ip: deque of (conn, addr) } in round-robin order
+        self.queued = 0
+        self.active = collections.Counter()  # { peer_ip: requests being served }
+        self.stats = collections.Counter()  # served, busy, refused, failed
+        self.select_thread = None
+
+    def start(self):
+        '''Start the selector thread and the worker pool.'''
+        self.running = True
+        self.select_thread = threading.Thread(target=self._select_loop, daemon=True)
+        self.select_thread.start()
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def stop(self):
+        '''Stop serving and close every connection, the selector and its wake-up sockets.'''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self._wake()
+        if self.select_thread is not None and self.select_thread is not threading.current_thread():
+            self.select_thread.join(timeout=2.0)  # Woken above, so it leaves its select() at once
+        for conn in list(self.connections):
+            self._close(conn)
+        self.selector.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+    def add(self, conn, addr):
+        '''Take over an accepted connection; returns False if it was refused because of the connection limits.'''
+        with self.condition:
+            if (len(self.connections) >= self.max_connections
+                    or self.connections_from[addr[0]] >= self.max_connections_per_peer):
+                self.stats["refused"] += 1
+                conn.close()
+                return False
+            self.connections[conn] = addr
+            self.connections_from[addr[0]] += 1
+        conn.settimeout(REQUEST_TIMEOUT)
+        self._return(conn)
+        return True
+
+    def _wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except OSError:
+            pass
+
+    def _return(self, conn):
+        '''Hand a connection to the selector thread to wait for its next request.'''
+        with self.condition:
+            self.returning.append(conn)
+        self._wake()
+
+    def _close(self, conn):
+        with self.condition:
+            addr = self.connections.pop(conn, None)
+            if addr is not None:
+                self.connections_from[addr[0]] -= 1
+                if not self.connections_from[addr[0]]:
+                    del self.connections_from[addr[0]]
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def _select_loop(self):
+        while self.running:
+            now = time.time()
+            for key, _ in self.selector.select(timeout=1.0):
+                if key.fileobj is self.wake_reader:
+                    try:
+                        while self.wake_reader.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                conn = key.fileobj
+                self.selector.unregister(conn)
+                self.idle_since.pop(conn, None)
+                self._enqueue(conn, key.data)
+
+            with self.condition:
+                returning, self.returning = self.returning, []
+            for conn in returning:
+                addr = self.connections.get(conn)
+                if addr is None:
+                    continue  # Closed in the meantime
+                self.selector.register(conn, selectors.EVENT_READ, addr)
+                self.idle_since[conn] = now
+
+            # Close connections that have been idle too long
+            for conn, since in list(self.idle_since.items()):
+                if now - since > self.idle_timeout:
+                    self.selector.unregister(conn)
+                    del self.idle_since[conn]
+                    self._close(conn)
+
+    def _enqueue(self, conn, addr):
+        '''Queue a connection with a request waiting, or turn the request away if the queue is full.'''
+        with self.condition:
+            if self.queued < self.max_queued:
+                self.waiting.setdefault(addr[0], collections.deque()).append((conn, addr))
+                self.queued += 1
+                self.condition.notify()
+                return
+            self.stats["busy"] += 1
+        self._reject(conn)
+
+    def _reject(self, conn):
+        '''Tell a framed client the seeder is busy so it retries elsewhere, then drop the connection.
+        This runs on the selector thread, so it never waits on the peer: the request is only peeked at,
+        its id echoed if it has fully arrived, and the reply dropped if it cannot be sent at once.'''
+        try:
+            conn.setblocking(False)
+            data = conn.recv(REJECT_PEEK_SIZE, socket.MSG_PEEK)
+            if is_framed(data):
+                request = decode_message(data)
+                reply = {"id": request["id"]} if request and "id" in request else {}
+                send_message(conn, dict(reply, status="busy", message="Seeder busy"))
+        except (OSError, ValueError):
+            pass
+        self._close(conn)
+
+    def _next_request(self):
+        '''Wait for the next peer in round-robin order that has a request waiting and a free slot.'''
+        with self.condition:
+            while self.running:
+                for peer_ip, requests in self.waiting.items():
+                    if self.active[peer_ip] < self.slots_per_peer:
+                        conn, addr = requests.popleft()
+                        if requests:
+                            self.waiting.move_to_end(peer_ip)
+                        else:
+                            del self.waiting[peer_ip]
+                        self.queued -= 1
+                        self.active[peer_ip] += 1
+                        return conn, addr
+                self.condition.wait()
+            return None, None
+
+    def _worker(self):
+        while True:
+            conn, addr = self._next_request()
+            if conn is None:
+                return
+            keep = False
+            outcome = "failed"
+            try:
+                keep = self.serve(conn, addr)
+                outcome = "served"
+            except Exception as e:
+                print('\033[31m'+f"Error serving {addr}: {e}"+'\033[0m')
+            finally:
+                with self.condition:
+                    self.stats[outcome] += 1
+                    self.active[addr[0]] -= 1
+                    if not self.active[addr[0]]:
+                        del self.active[addr[0]]
+                    self.condition.notify_all()
+            if keep and self.running:
+                self._return(conn)
+            else:
+                self._close(conn)